@@ -1,10 +1,36 @@
 import sublime
 import sublime_plugin
 import os.path
+import bisect
+import difflib
+import hashlib
+import json
+import mmap
+import struct
 import subprocess
-import re
+import sys
+import threading
+import Queue
 import time
 
+try:
+    import sqlite3
+except (ImportError):
+    sqlite3 = None
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except (ImportError):
+    try:
+        from xml.etree import ElementTree
+    except (ImportError):
+        ElementTree = None
+
+try:
+    from xml.parsers.expat import ExpatError
+except (ImportError):
+    ExpatError = SyntaxError
+
 
 class RepositoryNotFoundError(Exception):
     pass
@@ -14,7 +40,594 @@ class NotFoundError(Exception):
     pass
 
 
-file_status_cache = {}
+class UnsupportedFormatError(Exception):
+    pass
+
+
+class ProcessTimeoutError(Exception):
+    pass
+
+
+class ProcessError(Exception):
+    def __init__(self, message, returncode=None):
+        Exception.__init__(self, message)
+        self.returncode = returncode
+
+
+class LatencyHistogram(object):
+    """
+    Counts durations in buckets with fixed upper bounds in milliseconds, so
+    that percentiles can be estimated without keeping every sample
+    """
+    __slots__ = ['buckets', 'count', 'total', 'max']
+    bounds = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000,
+        5000, 10000, 30000, 60000]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, milliseconds):
+        self.buckets[bisect.bisect_left(self.bounds, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket holding the given fraction of
+        the samples, capped at the slowest one
+        """
+        rank = fraction * self.count
+        seen = 0
+        for i in range(len(self.buckets)):
+            seen += self.buckets[i]
+            if seen >= rank and seen:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                break
+        return self.max
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count if self.count else 0.0,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'max_ms': self.max,
+            'buckets': dict([('<=%g' % self.bounds[i] if i < len(self.bounds)
+                else '>%g' % self.bounds[-1], self.buckets[i]) for i in
+                range(len(self.buckets)) if self.buckets[i]])
+        }
+
+
+class Metrics():
+    """
+    Counters and latency histograms of VCS processes, helper processes, root
+    lookups, caches and UI thread work, keyed by names like
+    "process.run git status". While disabled, recording returns right away.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.started = time.time()
+            self.counters = {}
+            self.histograms = {}
+        finally:
+            self.lock.release()
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(name)
+            if histogram == None:
+                histogram = LatencyHistogram()
+                self.histograms[name] = histogram
+            histogram.add(seconds * 1000)
+        finally:
+            self.lock.release()
+
+    def timed(self, name):
+        """
+        Decorates a function to record its duration under name, or under the
+        class and function names if name contains "%s"
+        """
+        def decorator(fn):
+            def wrapper(instance, *args, **kwargs):
+                if not self.enabled:
+                    return fn(instance, *args, **kwargs)
+                start_time = time.time()
+                try:
+                    return fn(instance, *args, **kwargs)
+                finally:
+                    label = name
+                    if '%s' in name:
+                        label = name % (instance.__class__.__name__ + '.' +
+                            fn.__name__)
+                    self.observe(label, time.time() - start_time)
+            wrapper.__name__ = fn.__name__
+            wrapper.__doc__ = fn.__doc__
+            return wrapper
+        return decorator
+
+    def report(self):
+        self.lock.acquire()
+        try:
+            latencies = {}
+            for name, histogram in self.histograms.items():
+                latencies[name] = histogram.stats()
+            return {
+                'enabled': self.enabled,
+                'seconds': time.time() - self.started,
+                'counters': dict(self.counters),
+                'latencies': latencies,
+                'status_cache': status_cache.stats(),
+                'base_cache': base_cache.stats(),
+                'blame_cache': blame_cache.stats(),
+                'process_scheduler': process_scheduler.stats()
+            }
+        finally:
+            self.lock.release()
+
+    def format(self, report):
+        lines = ['Tortoise performance stats over %.1f seconds' %
+            report['seconds']]
+        if not report['enabled']:
+            lines.append('Collection is disabled, set "collect_metrics" ' +
+                'to true to record counters and latencies')
+
+        lines.extend(['', 'Latencies (ms)', '%-60s %7s %9s %9s %9s %9s' %
+            ('', 'count', 'mean', 'p50', 'p95', 'max')])
+        for name in sorted(report['latencies'].keys()):
+            stats = report['latencies'][name]
+            lines.append('%-60s %7d %9.1f %9.1f %9.1f %9.1f' % (name,
+                stats['count'], stats['mean_ms'], stats['p50_ms'],
+                stats['p95_ms'], stats['max_ms']))
+
+        lines.extend(['', 'Counters'])
+        for name in sorted(report['counters'].keys()):
+            lines.append('%-60s %7d' % (name, report['counters'][name]))
+
+        for section in ['status_cache', 'base_cache', 'blame_cache',
+                'process_scheduler']:
+            lines.extend(['', section.replace('_', ' ').capitalize()])
+            for name in sorted(report[section].keys()):
+                lines.append('%-60s %s' % (name, report[section][name]))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class StatusCacheEntry(object):
+    __slots__ = ['root_dir', 'path', 'status', 'fingerprint', 'signature',
+        'expires', 'prev', 'next']
+
+    def __init__(self, root_dir, path):
+        self.root_dir = root_dir
+        self.path = path
+        self.prev = self
+        self.next = self
+
+
+class StatusCache():
+    """
+    A bounded cache of file statuses, partitioned by repository root. Once
+    more than max_entries statuses are held, the least recently used ones are
+    evicted. Each partition also holds the latest status snapshot of its
+    repository.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.partitions = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Snapshots are replaced by the status worker thread, while entries
+        # are only ever touched on the UI thread
+        self.snapshots = {}
+        # Sentinel of the circular LRU list, most recently used first
+        self.lru = StatusCacheEntry(None, None)
+
+    def get(self, root_dir, path, fingerprint, signature):
+        """
+        Returns the cached status of path, or None if it is not cached or no
+        longer valid. With a fingerprint the entry must have been stored for
+        the same metadata and file signatures, without one it must not have
+        expired.
+        """
+        entry = self.partitions.get(root_dir, {}).get(path)
+        if entry != None:
+            if fingerprint != None:
+                fresh = entry.fingerprint == fingerprint and \
+                    entry.signature == signature
+            else:
+                fresh = entry.expires > time.time()
+            if fresh:
+                self.hits += 1
+                self.unlink(entry)
+                self.link(entry)
+                return entry.status
+        self.misses += 1
+        return None
+
+    def set(self, root_dir, path, status, fingerprint, signature,
+            cache_length):
+        partition = self.partitions.setdefault(root_dir, {})
+        entry = partition.get(path)
+        if entry == None:
+            entry = StatusCacheEntry(root_dir, path)
+            partition[path] = entry
+            self.size += 1
+        else:
+            self.unlink(entry)
+        entry.status = status
+        entry.fingerprint = fingerprint
+        entry.signature = signature
+        entry.expires = time.time() + cache_length
+        self.link(entry)
+
+        while self.size > self.max_entries:
+            self.evict(self.lru.prev)
+
+    def peek(self, root_dir, path):
+        """
+        Returns the last status stored for path even if it is no longer
+        valid, without affecting the LRU order or the statistics
+        """
+        entry = self.partitions.get(root_dir, {}).get(path)
+        if entry != None:
+            return entry.status
+
+        # Until the status of a file is cached, the one from the last
+        # snapshot, possibly loaded from disk, is the best known
+        snapshot = self.snapshots.get(root_dir)
+        if snapshot != None and not os.path.isdir(path):
+            return snapshot.get(path)
+        return None
+
+    def get_snapshot(self, root_dir):
+        return self.snapshots.get(root_dir)
+
+    def set_snapshot(self, root_dir, snapshot):
+        self.snapshots[root_dir] = snapshot
+
+    def clear(self, root_dir=None):
+        if root_dir != None:
+            roots = [root_dir]
+        else:
+            roots = set(self.partitions.keys() + self.snapshots.keys())
+        for root in roots:
+            for entry in self.partitions.get(root, {}).values():
+                self.remove(entry)
+            self.snapshots.pop(root, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': self.size,
+            'max_entries': self.max_entries,
+            'partitions': len(self.partitions),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0
+        }
+
+    def evict(self, entry):
+        self.remove(entry)
+        self.evictions += 1
+
+    def remove(self, entry):
+        self.unlink(entry)
+        partition = self.partitions[entry.root_dir]
+        del partition[entry.path]
+        if not partition:
+            del self.partitions[entry.root_dir]
+        self.size -= 1
+
+    def link(self, entry):
+        entry.prev = self.lru
+        entry.next = self.lru.next
+        self.lru.next.prev = entry
+        self.lru.next = entry
+
+    def unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+
+status_cache = StatusCache(10000)
+
+
+class ContentCache():
+    """
+    A small LRU cache of values that never change for their key, e.g. the
+    lines of a blob keyed by its id
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.values = {}
+        self.order = []
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            if key not in self.values:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.order.remove(key)
+            self.order.append(key)
+            return self.values[key]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        self.lock.acquire()
+        try:
+            if key in self.values:
+                self.order.remove(key)
+            self.values[key] = value
+            self.order.append(key)
+            while len(self.order) > self.max_entries:
+                del self.values[self.order.pop(0)]
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {
+            'entries': len(self.order),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+base_cache = ContentCache(64)
+blame_cache = ContentCache(32)
+
+
+class RootIndex():
+    """
+    Remembers which VCS metadata directories exist in each directory seen, so
+    that repository roots are found with dictionary lookups. Each directory
+    is re-checked with a single stat at most every recheck_interval seconds,
+    and its metadata directories are only looked for again when its mtime
+    shows that entries were added or removed.
+    """
+    # Later markers take precedence, e.g. a Git repository in an SVN checkout
+    markers = ['.svn', '.git', '.hg']
+    recheck_interval = 1.0
+
+    def __init__(self):
+        # dir -> [mtime, last check time, tuple of markers present]
+        self.dirs = {}
+        # dir -> (marker, root_dir) or None
+        self.results = {}
+
+    def find(self, path):
+        """
+        Returns a tuple of the marker directory name and the repository root
+        for path, or None if path is not within a working copy
+        """
+        cur_dir = path if os.path.isdir(path) else os.path.dirname(path)
+
+        ancestors = []
+        last_dir = None
+        while cur_dir != last_dir:
+            ancestors.append(cur_dir)
+            last_dir = cur_dir
+            cur_dir = os.path.dirname(cur_dir)
+
+        now = time.time()
+        changed = False
+        for dir in ancestors:
+            if self.check_dir(dir, now):
+                changed = True
+        if changed:
+            self.results.clear()
+
+        if ancestors[0] not in self.results:
+            metrics.count('root_index.misses')
+            self.results[ancestors[0]] = self.resolve(ancestors)
+        else:
+            metrics.count('root_index.hits')
+        return self.results[ancestors[0]]
+
+    def check_dir(self, dir, now):
+        """
+        Refreshes the markers of dir, returning True if they changed
+        """
+        entry = self.dirs.get(dir)
+        if entry != None and entry[1] > now - self.recheck_interval:
+            return False
+
+        metrics.count('root_index.stat')
+        try:
+            mtime = os.stat(dir).st_mtime
+        except (OSError):
+            mtime = None
+        if entry != None and entry[0] == mtime:
+            entry[1] = now
+            return False
+
+        if mtime != None:
+            metrics.count('root_index.exists', len(self.markers))
+        present = tuple([marker for marker in self.markers if
+            mtime != None and os.path.exists(os.path.join(dir, marker))])
+        self.dirs[dir] = [mtime, now, present]
+        return entry != None and entry[2] != present
+
+    def resolve(self, ancestors):
+        result = None
+        for marker in self.markers:
+            root_dir = None
+            for dir in ancestors:
+                if marker in self.dirs[dir][2]:
+                    root_dir = dir
+                    # Pre-1.7 SVN has a .svn directory in every directory of
+                    # the working copy, so the root is the topmost one
+                    if marker != '.svn':
+                        break
+                elif root_dir != None:
+                    break
+            if root_dir != None:
+                result = (marker, root_dir)
+        return result
+
+
+root_index = RootIndex()
+vcs_instances = {}
+
+
+class Config(object):
+    """
+    A read-only snapshot of the settings, with the paths of the Tortoise and
+    VCS executables resolved. It is built once the plugin is loaded and
+    rebuilt only when the settings change, so commands and menu predicates
+    never parse settings or probe the filesystem.
+    """
+    defaults = {
+        'svn_tortoiseproc_path': None,
+        'git_tortoiseproc_path': None,
+        'hg_hgtk_path': None,
+        'git_tgit_path': None,
+        'cache_validation': 'metadata',
+        'cache_length': 5,
+        'status_cache_size': 10000,
+        'persistent_cache': True,
+        'unknown_status': 'visible',
+        'prefetch_status': True,
+        'prefetch_save_delay': 500,
+        'max_processes': 4,
+        'max_processes_per_repo': 2,
+        'process_timeout': 60,
+        'hg_command_server': True,
+        'hg_command_server_timeout': 300,
+        'git_helper_processes': True,
+        'git_helper_timeout': 300,
+        'diff_gutter': True,
+        'diff_gutter_delay': 300,
+        'collect_metrics': False,
+        'enable_menus': True,
+        'debug': False
+    }
+
+    # Where the Tortoise executables are installed by default, relative to
+    # Program Files, in order of preference
+    install_paths = {
+        'svn_tortoiseproc_path': ['TortoiseSVN\\bin\\TortoiseProc.exe'],
+        'git_tortoiseproc_path': ['TortoiseGit\\bin\\TortoiseProc.exe'],
+        'hg_hgtk_path': ['TortoiseHg\\thgw.exe', 'TortoiseHg\\hgtk.exe']
+    }
+
+    def __init__(self, settings):
+        values = {}
+        for name, default in self.defaults.items():
+            value = settings.get(name)
+            values[name] = default if value == None else value
+
+        for name, path_suffixes in self.install_paths.items():
+            if not values[name]:
+                values[name] = self.find_program(path_suffixes)
+
+        # The command line clients are bundled with the Tortoise programs
+        git_tortoiseproc_path = values['git_tortoiseproc_path']
+        if not values['git_tgit_path'] and git_tortoiseproc_path:
+            values['git_tgit_path'] = os.path.dirname(
+                git_tortoiseproc_path) + '\\tgit.exe'
+        values['hg_path'] = None
+        if values['hg_hgtk_path']:
+            values['hg_path'] = os.path.dirname(values['hg_hgtk_path']) + \
+                '\\hg.exe'
+        values['svn_path'] = os.path.join(sublime.packages_path(), __name__,
+            'svn', 'svn.exe')
+        object.__setattr__(self, 'values', values)
+
+    def find_program(self, path_suffixes):
+        root_drive = os.path.expandvars('%HOMEDRIVE%\\')
+        for path_suffix in path_suffixes:
+            for dir in ['Program Files\\', 'Program Files (x86)\\']:
+                path = root_drive + dir + path_suffix
+                if os.path.exists(path):
+                    return path
+        return None
+
+    def __getattr__(self, name):
+        try:
+            return self.values[name]
+        except (KeyError):
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('The configuration is read-only')
+
+    def apply(self):
+        """
+        Passes the settings on to the module-level caches and schedulers
+        """
+        status_cache.max_entries = self.status_cache_size
+        process_scheduler.max_processes = self.max_processes
+        process_scheduler.max_processes_per_root = self.max_processes_per_repo
+        NonInteractiveProcess.timeout = self.process_timeout
+        snapshot_store.configure(self)
+        metrics.enabled = self.collect_metrics
+
+
+config = None
+
+
+def load_config():
+    global config
+    settings = sublime.load_settings('Tortoise.sublime-settings')
+    reload = config != None
+    config = Config(settings)
+    config.apply()
+
+    # The backends capture the executable paths and the helper process
+    # settings when they are created, so they are rebuilt on the next use
+    if reload:
+        for vcs in vcs_instances.values():
+            vcs.stop()
+        vcs_instances.clear()
+    return config
+
+
+def get_config():
+    # Only a command run before the plugin finished loading gets here
+    if config == None:
+        return load_config()
+    return config
+
+
+def plugin_loaded():
+    settings = sublime.load_settings('Tortoise.sublime-settings')
+    settings.clear_on_change('tortoise_config')
+    settings.add_on_change('tortoise_config', load_config)
+    load_config()
 
 
 class TortoiseCommand():
@@ -23,37 +636,74 @@ class TortoiseCommand():
             return self.window.active_view().file_name()
         return paths[0] if paths else self.window.active_view().file_name()
 
-    def get_vcs(self, path):
-        settings = sublime.load_settings('Tortoise.sublime-settings')
+    def get_paths(self, paths):
+        if paths == True or not paths:
+            return [self.window.active_view().file_name()]
+        return paths
+
+    def get_files(self, paths):
+        return [path for path in paths if not os.path.isdir(path)]
+
+    def get_vcs_paths(self, paths):
+        """
+        Returns the VCS of the selected paths, which must all be within the
+        same working copy, and the list of selected paths
+        """
+        paths = self.get_paths(paths)
+        vcs = self.get_vcs(paths[0])
+        for path in paths[1:]:
+            if self.get_vcs(path) is not vcs:
+                raise NotFoundError('The selected paths are not all in ' +
+                    'the same working copy')
+        return (vcs, paths)
 
+    def get_vcs(self, path):
         if path == None:
             raise NotFoundError('Unable to run commands on an unsaved file')
-        vcs = None
-
-        try:
-            vcs = TortoiseSVN(settings.get('svn_tortoiseproc_path'), path)
-        except (RepositoryNotFoundError):
-            pass
-
-        try:
-            vcs = TortoiseGit(settings.get('git_tortoiseproc_path'), path)
-        except (RepositoryNotFoundError):
-            pass
 
-        try:
-            vcs = TortoiseHg(settings.get('hg_hgtk_path'), path)
-        except (RepositoryNotFoundError):
-            pass
-
-        if vcs == None:
+        found = root_index.find(path)
+        if found == None:
             raise NotFoundError('The current file does not appear to be in an ' +
                 'SVN, Git or Mercurial working copy')
 
-        return vcs
+        marker, root_dir = found
+        backend, setting_name = {
+            '.svn': (TortoiseSVN, 'svn_tortoiseproc_path'),
+            '.git': (TortoiseGit, 'git_tortoiseproc_path'),
+            '.hg': (TortoiseHg, 'hg_hgtk_path')
+        }[marker]
+        binary_path = getattr(get_config(), setting_name)
+
+        key = (marker, root_dir, binary_path)
+        if key not in vcs_instances:
+            try:
+                vcs_instances[key] = backend(binary_path, root_dir)
+            except (RepositoryNotFoundError):
+                raise NotFoundError('The current file does not appear to ' +
+                    'be in an SVN, Git or Mercurial working copy')
+        return vcs_instances[key]
 
     def menus_enabled(self):
-        settings = sublime.load_settings('Tortoise.sublime-settings')
-        return settings.get('enable_menus', True)
+        return get_config().enable_menus
+
+    def has_status(self, vcs, paths, statuses):
+        """
+        Returns if every one of paths has one of statuses, querying all of
+        their statuses at once
+        """
+        if not paths:
+            return True
+        for status in vcs.get_statuses(paths):
+            if status == None:
+                if not self.unknown_status_visible():
+                    return False
+            elif status not in statuses:
+                return False
+        return True
+
+    def unknown_status_visible(self):
+        # The status is still being fetched in the background
+        return get_config().unknown_status == 'visible'
 
 
 def handles_not_found(fn):
@@ -62,7 +712,9 @@ def handles_not_found(fn):
             fn(self, *args, **kwargs)
         except (NotFoundError) as (exception):
             sublime.error_message('Tortoise: ' + str(exception))
-    return handler
+    handler.__name__ = fn.__name__
+    # Everything commands and menu predicates do blocks the UI thread
+    return metrics.timed('ui %s')(handler)
 
 
 def invisible_when_not_found(fn):
@@ -74,7 +726,8 @@ def invisible_when_not_found(fn):
             return True
         except (NotFoundError):
             return False
-    return handler
+    handler.__name__ = fn.__name__
+    return metrics.timed('ui %s')(handler)
 
 
 class TortoiseExploreCommand(sublime_plugin.WindowCommand, TortoiseCommand):
@@ -87,52 +740,46 @@ class TortoiseExploreCommand(sublime_plugin.WindowCommand, TortoiseCommand):
 class TortoiseCommitCommand(sublime_plugin.WindowCommand, TortoiseCommand):
     @handles_not_found
     def run(self, paths=None):
-        path = self.get_path(paths)
-        self.get_vcs(path).commit(path if os.path.isdir(path) else None)
+        vcs, paths = self.get_vcs_paths(paths)
+        dirs = [path for path in paths if os.path.isdir(path)]
+        vcs.commit(dirs or None)
 
     @invisible_when_not_found
     def is_visible(self, paths=None):
         if not self.menus_enabled():
             return False
-        path = self.get_path(paths)
-        if not path:
-            return False
-        self.get_vcs(path)
-        return os.path.isdir(path)
+        vcs, paths = self.get_vcs_paths(paths)
+        return not [path for path in paths if not os.path.isdir(path)]
 
 
 class TortoiseStatusCommand(sublime_plugin.WindowCommand, TortoiseCommand):
     @handles_not_found
     def run(self, paths=None):
-        path = self.get_path(paths)
-        self.get_vcs(path).status(path if os.path.isdir(path) else None)
+        vcs, paths = self.get_vcs_paths(paths)
+        dirs = [path for path in paths if os.path.isdir(path)]
+        vcs.status(dirs or None)
 
     @invisible_when_not_found
     def is_visible(self, paths=None):
         if not self.menus_enabled():
             return False
-        path = self.get_path(paths)
-        if not path:
-            return False
-        self.get_vcs(path)
-        return os.path.isdir(path)
+        vcs, paths = self.get_vcs_paths(paths)
+        return not [path for path in paths if not os.path.isdir(path)]
 
 
 class TortoiseSyncCommand(sublime_plugin.WindowCommand, TortoiseCommand):
     @handles_not_found
     def run(self, paths=None):
-        path = self.get_path(paths)
-        self.get_vcs(path).sync(path if os.path.isdir(path) else None)
+        vcs, paths = self.get_vcs_paths(paths)
+        dirs = [path for path in paths if os.path.isdir(path)]
+        vcs.sync(dirs or None)
 
     @invisible_when_not_found
     def is_visible(self, paths=None):
         if not self.menus_enabled():
             return False
-        path = self.get_path(paths)
-        if not path:
-            return False
-        self.get_vcs(path)
-        return os.path.isdir(path)
+        vcs, paths = self.get_vcs_paths(paths)
+        return not [path for path in paths if not os.path.isdir(path)]
 
 
 class TortoiseLogCommand(sublime_plugin.WindowCommand, TortoiseCommand):
@@ -145,20 +792,18 @@ class TortoiseLogCommand(sublime_plugin.WindowCommand, TortoiseCommand):
     def is_visible(self, paths=None):
         if not self.menus_enabled():
             return False
-        path = self.get_path(paths)
-        vcs = self.get_vcs(path)
-        if os.path.isdir(path):
-            return True
-        return path and vcs.get_status(path) in \
-            ['A', '', 'M', 'R', 'C', 'U']
+        vcs, paths = self.get_vcs_paths(paths)
+        # The log can only be shown for a single path
+        if len(paths) > 1:
+            return False
+        return self.has_status(vcs, self.get_files(paths),
+            ['A', '', 'M', 'R', 'C', 'U'])
 
     @invisible_when_not_found
     def is_enabled(self, paths=None):
-        path = self.get_path(paths)
-        if os.path.isdir(path):
-            return True
-        return path and self.get_vcs(path).get_status(path) in \
-            ['', 'M', 'R', 'C', 'U']
+        vcs, paths = self.get_vcs_paths(paths)
+        return self.has_status(vcs, self.get_files(paths),
+            ['', 'M', 'R', 'C', 'U'])
 
 class TortoiseBlameCommand(sublime_plugin.WindowCommand, TortoiseCommand):
     @handles_not_found
@@ -170,20 +815,17 @@ class TortoiseBlameCommand(sublime_plugin.WindowCommand, TortoiseCommand):
     def is_visible(self, paths=None):
         if not self.menus_enabled():
             return False
-        path = self.get_path(paths)
-        if os.path.isdir(path):
+        vcs, paths = self.get_vcs_paths(paths)
+        if len(paths) > 1 or os.path.isdir(paths[0]):
             return False
-        vcs = self.get_vcs(path)
-        return path and vcs.get_status(path) in \
-            ['A', '', 'M', 'R', 'C', 'U']
+        return self.has_status(vcs, paths, ['A', '', 'M', 'R', 'C', 'U'])
 
     @invisible_when_not_found
     def is_enabled(self, paths=None):
-        path = self.get_path(paths)
-        if os.path.isdir(path):
+        vcs, paths = self.get_vcs_paths(paths)
+        if os.path.isdir(paths[0]):
             return False
-        return path and self.get_vcs(path).get_status(path) in \
-            ['A', '', 'M', 'R', 'C', 'U']
+        return self.has_status(vcs, paths, ['A', '', 'M', 'R', 'C', 'U'])
 
 class TortoiseDiffCommand(sublime_plugin.WindowCommand, TortoiseCommand):
     @handles_not_found
@@ -195,89 +837,583 @@ class TortoiseDiffCommand(sublime_plugin.WindowCommand, TortoiseCommand):
     def is_visible(self, paths=None):
         if not self.menus_enabled():
             return False
-        path = self.get_path(paths)
-        vcs = self.get_vcs(path)
-        if os.path.isdir(path):
-            return True
-        return vcs.get_status(path) in \
-            ['A', '', 'M', 'R', 'C', 'U']
+        vcs, paths = self.get_vcs_paths(paths)
+        # Diffs can only be shown for a single path
+        if len(paths) > 1:
+            return False
+        return self.has_status(vcs, self.get_files(paths),
+            ['A', '', 'M', 'R', 'C', 'U'])
 
     @invisible_when_not_found
     def is_enabled(self, paths=None):
-        path = self.get_path(paths)
-        if os.path.isdir(path):
-            return True
-        vcs = self.get_vcs(path)
+        vcs, paths = self.get_vcs_paths(paths)
         if isinstance(vcs, TortoiseHg):
-            return vcs.get_status(path) in ['M']
+            return self.has_status(vcs, self.get_files(paths), ['M'])
         else:
-            return vcs.get_status(path) in ['A', 'M', 'R', 'C', 'U']
+            return self.has_status(vcs, self.get_files(paths),
+                ['A', 'M', 'R', 'C', 'U'])
 
 
 class TortoiseAddCommand(sublime_plugin.WindowCommand, TortoiseCommand):
     @handles_not_found
     def run(self, paths=None):
-        path = self.get_path(paths)
-        self.get_vcs(path).add(path)
+        vcs, paths = self.get_vcs_paths(paths)
+        vcs.add(paths)
 
     @invisible_when_not_found
     def is_visible(self, paths=None):
         if not self.menus_enabled():
             return False
-        path = self.get_path(paths)
-        return self.get_vcs(path).get_status(path) in ['D', '?']
+        vcs, paths = self.get_vcs_paths(paths)
+        return self.has_status(vcs, paths, ['D', '?'])
 
 
 class TortoiseRemoveCommand(sublime_plugin.WindowCommand, TortoiseCommand):
     @handles_not_found
     def run(self, paths=None):
-        path = self.get_path(paths)
-        self.get_vcs(path).remove(path)
+        vcs, paths = self.get_vcs_paths(paths)
+        vcs.remove(paths)
 
     @invisible_when_not_found
     def is_visible(self, paths=None):
         if not self.menus_enabled():
             return False
-        path = self.get_path(paths)
-        return self.get_vcs(path).get_status(path) in \
-            ['A', '', 'M', 'R', 'C', 'U']
+        vcs, paths = self.get_vcs_paths(paths)
+        return self.has_status(vcs, paths, ['A', '', 'M', 'R', 'C', 'U'])
 
     @invisible_when_not_found
     def is_enabled(self, paths=None):
-        path = self.get_path(paths)
-        if os.path.isdir(path):
-            return True
-        return self.get_vcs(path).get_status(path) in ['']
+        vcs, paths = self.get_vcs_paths(paths)
+        return self.has_status(vcs, self.get_files(paths), [''])
 
 
 class TortoiseRevertCommand(sublime_plugin.WindowCommand, TortoiseCommand):
     @handles_not_found
     def run(self, paths=None):
-        path = self.get_path(paths)
-        self.get_vcs(path).revert(path)
+        vcs, paths = self.get_vcs_paths(paths)
+        vcs.revert(paths)
 
     @invisible_when_not_found
     def is_visible(self, paths=None):
         if not self.menus_enabled():
             return False
-        path = self.get_path(paths)
-        return self.get_vcs(path).get_status(path) in \
-            ['A', '', 'M', 'R', 'C', 'U']
+        vcs, paths = self.get_vcs_paths(paths)
+        return self.has_status(vcs, paths, ['A', '', 'M', 'R', 'C', 'U'])
 
     @invisible_when_not_found
     def is_enabled(self, paths=None):
+        vcs, paths = self.get_vcs_paths(paths)
+        return self.has_status(vcs, self.get_files(paths),
+            ['A', 'M', 'R', 'C', 'U'])
+
+
+class ChangedFiles():
+    """
+    The quick panel entries of the changed files of each working copy, built
+    from its latest status snapshot a chunk at a time so that the UI stays
+    responsive with tens of thousands of changes. The entries are reused
+    until the snapshot is replaced or updated.
+    """
+    statuses = ['M', 'A', 'R', 'C', 'U', '?']
+    chunk_size = 5000
+
+    def __init__(self):
+        # root_dir -> (snapshot, version, paths, entries)
+        self.lists = {}
+        self.generations = {}
+
+    def get(self, snapshot, callback):
+        """
+        Calls callback with the paths and entries of the changed files of
+        snapshot, sorted by path, once they have been built
+        """
+        root_dir = snapshot.root_dir
+        version = snapshot.statuses.version
+        built = self.lists.get(root_dir)
+        if built != None and built[0] is snapshot and built[1] == version:
+            callback(built[2], built[3])
+            return
+
+        generation = self.generations.get(root_dir, 0) + 1
+        self.generations[root_dir] = generation
+        # The store keeps its keys sorted
+        records = snapshot.statuses.iteritems()
+        paths = []
+        entries = []
+
+        def build():
+            # A later request for the same working copy takes over
+            if self.generations.get(root_dir) != generation:
+                return
+            count = 0
+            for key, status in records:
+                if status in self.statuses:
+                    paths.append(os.path.join(root_dir, key))
+                    entries.append('%s  %s' % (status, key))
+                count += 1
+                if count == self.chunk_size:
+                    sublime.set_timeout(build, 0)
+                    return
+            self.lists[root_dir] = (snapshot, version, paths, entries)
+            callback(paths, entries)
+        build()
+
+
+changed_files = ChangedFiles()
+
+
+class TortoiseChangedFilesCommand(sublime_plugin.WindowCommand,
+        TortoiseCommand):
+    """
+    Lists the changed files of the working copy in a quick panel and opens
+    the selected one. The last known statuses are listed right away while
+    they are refreshed in the background.
+    """
+    @handles_not_found
+    def run(self, paths=None):
+        vcs = self.get_vcs(self.get_working_copy_path(paths))
+        snapshot = status_cache.get_snapshot(vcs.root_dir)
+        vcs.prefetch([])
+        if snapshot != None:
+            changed_files.get(snapshot, self.show)
+            return
+        sublime.status_message('Tortoise: Reading the status of ' +
+            vcs.root_dir)
+        self.wait(vcs.root_dir, time.time())
+
+    def get_working_copy_path(self, paths):
         path = self.get_path(paths)
-        if os.path.isdir(path):
-            return True
-        return self.get_vcs(path).get_status(path) in \
-            ['A', 'M', 'R', 'C', 'U']
+        if path == None and self.window.folders():
+            path = self.window.folders()[0]
+        return path
+
+    def wait(self, root_dir, start_time):
+        snapshot = status_cache.get_snapshot(root_dir)
+        if snapshot != None:
+            changed_files.get(snapshot, self.show)
+        elif time.time() - start_time < get_config().process_timeout:
+            sublime.set_timeout(lambda: self.wait(root_dir, start_time), 100)
+
+    def show(self, paths, entries):
+        if not entries:
+            sublime.status_message('Tortoise: No changed files')
+            return
+
+        def on_done(index):
+            if index == -1:
+                return
+            if os.path.isdir(paths[index]):
+                sublime.status_message('Tortoise: ' + paths[index] +
+                    ' is an unversioned directory')
+                return
+            self.window.open_file(paths[index])
+        self.window.show_quick_panel(entries, on_done)
+
+    @invisible_when_not_found
+    def is_visible(self, paths=None):
+        if not self.menus_enabled():
+            return False
+        self.get_vcs(self.get_working_copy_path(paths))
+        return True
+
+
+class TortoisePerformanceStatsCommand(sublime_plugin.WindowCommand):
+    """
+    Shows the collected metrics in a new view, as a table or as JSON
+    """
+    def run(self, format='text'):
+        report = metrics.report()
+        if format == 'json':
+            text = json.dumps(report, indent=2, sort_keys=True) + '\n'
+        else:
+            text = metrics.format(report)
+
+        view = self.window.new_file()
+        view.set_name('Tortoise Performance Stats')
+        view.set_scratch(True)
+        edit = view.begin_edit()
+        view.insert(edit, 0, text)
+        view.end_edit(edit)
+
+
+class TortoisePrefetchListener(sublime_plugin.EventListener,
+        TortoiseCommand):
+    """
+    Refreshes the statuses of a file's working copy in the background when
+    the file is loaded, focused or saved, before any menu asks for them
+    """
+    def __init__(self):
+        # Saved paths per working copy that are waiting for the save delay
+        self.saves = {}
+        self.generations = {}
+
+    def get_prefetch_vcs(self, view):
+        if not get_config().prefetch_status:
+            return None
+        if view.file_name() == None:
+            return None
+        try:
+            return self.get_vcs(view.file_name())
+        except (NotFoundError):
+            return None
+
+    @metrics.timed('ui %s')
+    def prefetch(self, view):
+        vcs = self.get_prefetch_vcs(view)
+        if vcs != None:
+            vcs.prefetch([view.file_name()])
+
+    def on_load(self, view):
+        self.prefetch(view)
+
+    def on_activated(self, view):
+        self.prefetch(view)
+
+    def on_post_save(self, view):
+        vcs = self.get_prefetch_vcs(view)
+        if vcs == None:
+            return
+
+        # A burst of saves, e.g. Save All, is coalesced into one refresh
+        # once no more saves have happened in the working copy for a while
+        root_dir = vcs.root_dir
+        if view.file_name() not in self.saves.setdefault(root_dir, []):
+            self.saves[root_dir].append(view.file_name())
+        generation = self.generations.get(root_dir, 0) + 1
+        self.generations[root_dir] = generation
+
+        def refresh():
+            if self.generations.get(root_dir) != generation:
+                return
+            paths = self.saves.pop(root_dir, [])
+            if paths:
+                vcs.prefetch(paths)
+
+        sublime.set_timeout(refresh, get_config().prefetch_save_delay)
+
+
+class LineDiff():
+    """
+    The lines of a buffer aligned with the lines of its base content. Every
+    buffer line maps to the index of the same base line, or to None if it
+    was added or modified. After an edit only the lines between the nearest
+    unchanged lines around it are diffed again.
+    """
+    def __init__(self, base_id, base):
+        self.base_id = base_id
+        self.base = base
+        self.lines = []
+        self.base_indexes = []
+
+    def update(self, lines):
+        old = self.lines
+        length = min(len(old), len(lines))
+        start = 0
+        while start < length and old[start] == lines[start]:
+            start += 1
+        end = 0
+        while end < length - start and old[-1 - end] == lines[-1 - end]:
+            end += 1
+
+        # Widen the edited range to the unchanged lines around it
+        before = start - 1
+        while before >= 0 and self.base_indexes[before] == None:
+            before -= 1
+        after = len(old) - end
+        while after < len(old) and self.base_indexes[after] == None:
+            after += 1
+
+        base_start = 0
+        if before >= 0:
+            base_start = self.base_indexes[before] + 1
+        base_end = len(self.base)
+        if after < len(old):
+            base_end = self.base_indexes[after]
+        new_end = len(lines) - (len(old) - after)
+
+        middle = [None] * (new_end - before - 1)
+        matcher = self.get_matcher(self.base[base_start:base_end],
+            lines[before + 1:new_end])
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                for offset in range(j2 - j1):
+                    middle[j1 + offset] = base_start + i1 + offset
+
+        self.base_indexes = self.base_indexes[:before + 1] + middle + \
+            self.base_indexes[after:]
+        self.lines = lines
+
+    def get_matcher(self, a, b):
+        try:
+            return difflib.SequenceMatcher(None, a, b, autojunk=False)
+        except (TypeError):
+            # Python 2.6 always treats popular lines as junk
+            return difflib.SequenceMatcher(None, a, b)
+
+    def get_changes(self):
+        """
+        Returns lists of the added and modified rows, and of the rows that
+        base lines were deleted before
+        """
+        added = []
+        modified = []
+        deleted = []
+        run = []
+        previous = -1
+        for row, index in enumerate(self.base_indexes + [len(self.base)]):
+            if index == None:
+                run.append(row)
+                continue
+            removed = index - previous - 1
+            if run and removed:
+                modified.extend(run)
+            elif run:
+                added.extend(run)
+            elif removed:
+                deleted.append(min(row, max(len(self.lines) - 1, 0)))
+            run = []
+            previous = index
+        return (added, modified, deleted)
+
+
+# The line diffs of open views against their base content, and the blame of
+# the base lines of views showing inline blame, by view id
+view_diffs = {}
+view_blames = {}
+
+
+class InlineBlame():
+    """
+    Shows the revision and author of every line of a view in an output
+    panel. Edited lines are mapped to their base lines through the line diff
+    of the view, so blame only runs once per revision.
+    """
+    key = 'tortoise_blame'
+
+    def show(self, view, base, blame):
+        if base == None or blame == None:
+            sublime.status_message('Tortoise: No blame available for ' +
+                'this file')
+            self.hide(view)
+            return
+        diff = view_diffs.get(view.id())
+        if diff == None or diff.base_id != base[0]:
+            diff = LineDiff(base[0], base[1])
+            view_diffs[view.id()] = diff
+            diff.update(view.substr(sublime.Region(0,
+                view.size())).split('\n'))
+        view_blames[view.id()] = blame
+        self.draw(view)
+
+    def hide(self, view):
+        view_blames.pop(view.id(), None)
+        if view.window() != None:
+            view.window().run_command('hide_panel',
+                {'panel': 'output.' + self.key})
+
+    def get_annotations(self, view):
+        diff = view_diffs[view.id()]
+        blame = view_blames[view.id()]
+        annotations = []
+        for index in diff.base_indexes:
+            if index != None and index < len(blame):
+                annotations.append('%s %s' % blame[index])
+            else:
+                annotations.append('Not committed yet')
+        return annotations
+
+    def draw(self, view):
+        if view.id() not in view_blames:
+            return
+        annotations = self.get_annotations(view)
+
+        window = view.window()
+        if window == None:
+            return
+        lines = []
+        for row in range(len(annotations)):
+            lines.append('%5d  %s' % (row + 1, annotations[row]))
+        panel = window.get_output_panel(self.key)
+        edit = panel.begin_edit()
+        panel.erase(edit, sublime.Region(0, panel.size()))
+        panel.insert(edit, 0, '\n'.join(lines))
+        panel.end_edit(edit)
+        window.run_command('show_panel', {'panel': 'output.' + self.key})
+
+
+inline_blame = InlineBlame()
+
+
+class TortoiseInlineBlameCommand(sublime_plugin.WindowCommand,
+        TortoiseCommand):
+    @handles_not_found
+    def run(self, paths=None):
+        view = self.window.active_view()
+        if view.id() in view_blames:
+            inline_blame.hide(view)
+            return
+
+        path = view.file_name()
+        vcs = self.get_vcs(path).get_backend()
+
+        def read_blame():
+            try:
+                base = vcs.get_base(path)
+                blame = None
+                if base != None:
+                    blame = vcs.get_blame(path, base[0])
+            except (Exception) as (exception):
+                message = str(exception)
+                sublime.set_timeout(lambda: sublime.error_message(message), 0)
+                return
+            sublime.set_timeout(lambda: inline_blame.show(view, base, blame),
+                0)
+        thread = threading.Thread(target=read_blame)
+        thread.daemon = True
+        thread.start()
+
+    @invisible_when_not_found
+    def is_visible(self, paths=None):
+        if not self.menus_enabled():
+            return False
+        vcs, paths = self.get_vcs_paths(None)
+        return self.has_status(vcs, paths, ['', 'M', 'R', 'C', 'U'])
+
+
+class TortoiseDiffGutterListener(sublime_plugin.EventListener,
+        TortoiseCommand):
+    """
+    Marks the lines of open files that differ from the base revision in the
+    gutter, and keeps inline blame in line with edits. The base content is
+    read once per blob in the background, the buffer is diffed against it
+    in-process once typing has paused.
+    """
+    def __init__(self):
+        self.generations = {}
+        # view id -> (path, metadata fingerprint, base id) of the last base
+        self.bases = {}
+
+    def is_gutter_enabled(self):
+        return get_config().diff_gutter
+
+    def on_load(self, view):
+        self.refresh_base(view)
+
+    def on_activated(self, view):
+        self.refresh_base(view)
+
+    def on_post_save(self, view):
+        self.refresh_base(view)
+
+    def on_close(self, view):
+        view_diffs.pop(view.id(), None)
+        view_blames.pop(view.id(), None)
+        self.generations.pop(view.id(), None)
+        self.bases.pop(view.id(), None)
+
+    def on_modified(self, view):
+        if view.id() not in view_diffs:
+            return
+        generation = self.generations.get(view.id(), 0) + 1
+        self.generations[view.id()] = generation
+
+        def update():
+            if self.generations.get(view.id()) == generation:
+                self.update(view)
+
+        sublime.set_timeout(update, get_config().diff_gutter_delay)
+
+    def refresh_base(self, view):
+        path = view.file_name()
+        blamed = view.id() in view_blames
+        if path == None or not (blamed or self.is_gutter_enabled()):
+            return
+        try:
+            vcs = self.get_vcs(path).get_backend()
+        except (NotFoundError):
+            return
+
+        # The base only changes along with the VCS metadata, so while that is
+        # unchanged the known base is reused without reading it again
+        fingerprint = vcs.get_fingerprint()
+        known = self.bases.get(view.id())
+        if fingerprint != None and known != None and \
+                known[:2] == (path, fingerprint):
+            if known[2] == None:
+                return
+            lines = base_cache.get(known[2])
+            if lines != None:
+                diff = view_diffs.get(view.id())
+                if diff == None or diff.base_id != known[2]:
+                    self.set_base(view, (known[2], lines),
+                        view_blames.get(view.id()), fingerprint)
+                return
+
+        # The base id changes after commits and updates, reading it may
+        # have to run the VCS
+        def read_base():
+            blame = None
+            base_fingerprint = fingerprint
+            try:
+                base = vcs.get_base(path)
+                if blamed and base != None:
+                    blame = vcs.get_blame(path, base[0])
+            except (Exception) as (exception):
+                if get_config().debug:
+                    print 'Tortoise: Unable to read the base of %s: %s' % (
+                        path, str(exception))
+                # Failures are not remembered, so the base is read again
+                base = None
+                base_fingerprint = None
+            sublime.set_timeout(lambda: self.set_base(view, base, blame,
+                base_fingerprint), 0)
+        thread = threading.Thread(target=read_base)
+        thread.daemon = True
+        thread.start()
+
+    def set_base(self, view, base, blame, fingerprint=None):
+        self.bases[view.id()] = (view.file_name(), fingerprint,
+            base[0] if base != None else None)
+        if view.id() in view_blames:
+            inline_blame.show(view, base, blame)
+        if base == None:
+            view_diffs.pop(view.id(), None)
+            self.draw(view, ([], [], []))
+            return
+        diff = view_diffs.get(view.id())
+        if diff == None or diff.base_id != base[0]:
+            view_diffs[view.id()] = LineDiff(base[0], base[1])
+        self.update(view)
+
+    @metrics.timed('ui %s')
+    def update(self, view):
+        diff = view_diffs.get(view.id())
+        if diff == None:
+            return
+        diff.update(view.substr(sublime.Region(0, view.size())).split('\n'))
+        if self.is_gutter_enabled():
+            self.draw(view, diff.get_changes())
+        inline_blame.draw(view)
+
+    def draw(self, view, changes):
+        flags = sublime.HIDDEN | sublime.PERSISTENT
+        names = ['added', 'modified', 'deleted']
+        scopes = ['markup.inserted', 'markup.changed', 'markup.deleted']
+        icons = ['dot', 'dot', 'circle']
+        for i in range(3):
+            regions = [view.line(view.text_point(row, 0)) for row in
+                changes[i]]
+            view.add_regions('tortoise_' + names[i], regions, scopes[i],
+                icons[i], flags)
 
 
 class ForkGui():
     def __init__(self, cmd, cwd):
+        start_time = time.time()
         subprocess.Popen(cmd, stdin=subprocess.PIPE,
             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
             cwd=cwd)
+        metrics.observe('gui.spawn', time.time() - start_time)
 
 
 class Tortoise():
@@ -301,22 +1437,14 @@ class Tortoise():
                 ' directory')
         self.root_dir = root_dir
 
-    def set_binary_path(self, path_suffix, binary_name, setting_name):
-        root_drive = os.path.expandvars('%HOMEDRIVE%\\')
+    def set_binary_path(self, path, binary_name, setting_name):
+        # The configuration has already looked for it in Program Files
+        self.path = path
+        if path != None:
+            return
 
-        possible_dirs = [
-            'Program Files\\',
-            'Program Files (x86)\\'
-        ]
-
-        for dir in possible_dirs:
-            path = root_drive + dir + path_suffix
-            if os.path.exists(path):
-                self.path = path
-                return
-
-        self.path = None
-        normal_path = root_drive + possible_dirs[0] + path_suffix
+        normal_path = os.path.expandvars('%HOMEDRIVE%\\') + \
+            'Program Files\\' + Config.install_paths[setting_name][0]
         raise NotFoundError('Unable to find ' + self.__class__.__name__ +
                             '.\n\nPlease add the path to ' + binary_name +
                             ' to the setting "' + setting_name + '" in "' +
@@ -331,279 +1459,2522 @@ class Tortoise():
         else:
             ForkGui('explorer.exe "' + os.path.dirname(path) + '"', None)
 
-    def process_status(self, vcs, path):
-        global file_status_cache
-        settings = sublime.load_settings('Tortoise.sublime-settings')
-        if path in file_status_cache and file_status_cache[path]['time'] > \
-                time.time() - settings.get('cache_length'):
-            if settings.get('debug'):
-                print 'Fetching cached status for %s' % path
-            return file_status_cache[path]['status']
-
-        if settings.get('debug'):
-            start_time = time.time()
+    def stop(self):
+        for name in ['svn', 'git', 'hg']:
+            if hasattr(self, name):
+                getattr(self, name).stop()
 
-        try:
-            status = vcs.check_status(path)
-        except (Exception) as (exception):
-            sublime.error_message(str(exception))
+    def get_status(self, path):
+        return self.get_statuses([path])[0]
+
+    def get_statuses(self, paths):
+        return self.process_statuses(self.get_backend(), paths)
+
+    def prefetch(self, paths):
+        """
+        Queues a low-priority refresh of the statuses of paths and of the
+        whole working copy, so that later menu lookups are cache hits
+        """
+        self.process_statuses(self.get_backend(), paths + [self.root_dir],
+            StatusRequest.PREFETCH)
+
+    def get_base(self, path):
+        return self.get_backend().get_base(path)
+
+    def get_relative_paths(self, paths):
+        if paths == None:
+            paths = [self.root_dir]
+        elif not isinstance(paths, list):
+            paths = [paths]
+        return [os.path.relpath(path, self.root_dir) for path in paths]
+
+    def process_statuses(self, vcs, paths, priority=None):
+        """
+        Returns the cached statuses of paths, or the last known ones while a
+        refresh of all of the missing ones is queued with the status service.
+        None means that a status is not known yet.
+        """
+        config = get_config()
+        if priority == None:
+            priority = StatusRequest.INTERACTIVE
+
+        # Unless configured to use a fixed TTL, cached statuses stay valid
+        # for as long as the VCS metadata and the file itself are unchanged
+        fingerprint = None
+        if config.cache_validation == 'metadata':
+            fingerprint = vcs.get_fingerprint()
+
+        backend_name = vcs.__class__.__name__
+        statuses = []
+        missing_paths = []
+        missing_signatures = []
+        for path in paths:
+            signature = None
+            if fingerprint != None:
+                signature = stat_signature(path)
+            status = status_cache.get(self.root_dir, path, fingerprint,
+                signature)
+            if status != None:
+                metrics.count('status_cache.hits ' + backend_name)
+                if config.debug:
+                    print 'Fetching cached status for %s' % path
+            else:
+                metrics.count('status_cache.misses ' + backend_name)
+                missing_paths.append(path)
+                missing_signatures.append(signature)
+                status = status_cache.peek(self.root_dir, path)
+            statuses.append(status)
 
-        file_status_cache[path] = {
-            'time': time.time() + settings.get('cache_length'),
-            'status': status
-        }
+        if missing_paths:
+            status_service.request(StatusRequest(vcs, missing_paths,
+                fingerprint, missing_signatures, config.cache_length,
+                config.debug, priority))
+        return statuses
 
-        if settings.get('debug'):
-            print 'Fetching status for %s in %s seconds' % (path,
-                str(time.time() - start_time))
 
-        return status
+class TortoiseProc(Tortoise):
+    def run_command(self, command, paths):
+        # TortoiseProc accepts multiple paths separated by asterisks
+        ForkGui('"' + self.path + '" /command:' + command + ' /path:"%s"' %
+            '*'.join(self.get_relative_paths(paths)), self.root_dir)
 
+    def status(self, paths=None):
+        self.run_command('repostatus', paths)
 
-class TortoiseProc(Tortoise):
-    def status(self, path=None):
-        path = self.root_dir if path == None else path
-        path = os.path.relpath(path, self.root_dir)
-        ForkGui('"' + self.path + '" /command:repostatus /path:"%s"' % path,
-            self.root_dir)
-
-    def commit(self, path=None):
-        path = self.root_dir if path == None else path
-        path = os.path.relpath(path, self.root_dir)
-        ForkGui('"' + self.path + '" /command:commit /path:"%s"' % path,
-            self.root_dir)
+    def commit(self, paths=None):
+        self.run_command('commit', paths)
 
     def log(self, path=None):
-        path = self.root_dir if path == None else path
-        path = os.path.relpath(path, self.root_dir)
-        ForkGui('"' + self.path + '" /command:log /path:"%s"' % path,
-            self.root_dir)
+        self.run_command('log', path)
 
     def blame(self, path=None):
-        path = self.root_dir if path == None else path
-        path = os.path.relpath(path, self.root_dir)
-        ForkGui('"' + self.path + '" /command:blame /path:"%s"' % path,
-            self.root_dir)
+        self.run_command('blame', path)
 
     def diff(self, path):
-        path = os.path.relpath(path, self.root_dir)
-        ForkGui('"' + self.path + '" /command:diff /path:"%s"' % path,
-            self.root_dir)
+        self.run_command('diff', path)
 
-    def add(self, path):
-        path = os.path.relpath(path, self.root_dir)
-        ForkGui('"' + self.path + '" /command:add /path:"%s"' % path,
-            self.root_dir)
+    def add(self, paths):
+        self.run_command('add', paths)
 
-    def remove(self, path):
-        path = os.path.relpath(path, self.root_dir)
-        ForkGui('"' + self.path + '" /command:remove /path:"%s"' % path,
-            self.root_dir)
+    def remove(self, paths):
+        self.run_command('remove', paths)
 
-    def revert(self, path):
-        path = os.path.relpath(path, self.root_dir)
-        ForkGui('"' + self.path + '" /command:revert /path:"%s"' % path,
-            self.root_dir)
+    def revert(self, paths):
+        self.run_command('revert', paths)
 
 
 class TortoiseSVN(TortoiseProc):
     def __init__(self, binary_path, file):
         self.find_root('.svn', file, False)
-        if binary_path != None:
-            self.path = binary_path
-        else:
-            self.set_binary_path('TortoiseSVN\\bin\\TortoiseProc.exe',
-                'TortoiseProc.exe', 'svn_tortoiseproc_path')
+        self.set_binary_path(binary_path, 'TortoiseProc.exe',
+            'svn_tortoiseproc_path')
 
-    def sync(self, path=None):
-        path = self.root_dir if path == None else path
-        path = os.path.relpath(path, self.root_dir)
-        ForkGui('"' + self.path + '" /command:update /path:"%s"' % path,
-            self.root_dir)
+    def sync(self, paths=None):
+        self.run_command('update', paths)
 
-    def get_status(self, path):
-        svn = SVN(self.root_dir)
-        return self.process_status(svn, path)
+    def get_backend(self):
+        if not hasattr(self, 'svn'):
+            self.svn = SVN(self.root_dir)
+        return self.svn
 
 
 class TortoiseGit(TortoiseProc):
     def __init__(self, binary_path, file):
         self.find_root('.git', file)
-        if binary_path != None:
-            self.path = binary_path
-        else:
-            self.set_binary_path('TortoiseGit\\bin\\TortoiseProc.exe',
-                'TortoiseProc.exe', 'git_tortoiseproc_path')
+        self.set_binary_path(binary_path, 'TortoiseProc.exe',
+            'git_tortoiseproc_path')
 
-    def sync(self, path=None):
-        path = self.root_dir if path == None else path
-        path = os.path.relpath(path, self.root_dir)
-        ForkGui('"' + self.path + '" /command:sync /path:"%s"' % path,
-            self.root_dir)
+    def sync(self, paths=None):
+        self.run_command('sync', paths)
 
-    def get_status(self, path):
-        git = Git(self.path, self.root_dir)
-        return self.process_status(git, path)
+    def get_backend(self):
+        if not hasattr(self, 'git'):
+            self.git = Git(get_config().git_tgit_path, self.root_dir)
+        return self.git
 
 
 class TortoiseHg(Tortoise):
     def __init__(self, binary_path, file):
         self.find_root('.hg', file)
-        if binary_path != None:
-            self.path = binary_path
-        else:
-            try:
-                self.set_binary_path('TortoiseHg\\thgw.exe',
-                    'thgw.exe', 'hg_hgtk_path')
-            except (NotFoundError):
-                self.set_binary_path('TortoiseHg\\hgtk.exe',
-                    'thgw.exe (for TortoiseHg v2.x) or hgtk.exe (for ' +
-                    'TortoiseHg v1.x)', 'hg_hgtk_path')
-
-    def status(self, path=None):
-        path = os.path.relpath(path, self.root_dir)
-        args = [self.path, 'status', '--nofork', path]
-        ForkGui(args, self.root_dir)
+        self.set_binary_path(binary_path, 'thgw.exe (for TortoiseHg v2.x) ' +
+            'or hgtk.exe (for TortoiseHg v1.x)', 'hg_hgtk_path')
 
-    def commit(self, path=None):
-        path = os.path.relpath(path, self.root_dir)
-        args = [self.path, 'commit', '--nofork', path]
+    def run_command(self, command, paths):
+        args = [self.path, command, '--nofork'] + \
+            self.get_relative_paths(paths)
         ForkGui(args, self.root_dir)
 
-    def sync(self, path=None):
-        path = os.path.relpath(path, self.root_dir)
-        args = [self.path, 'synch', '--nofork', path]
-        ForkGui(args, self.root_dir)
+    def status(self, paths=None):
+        self.run_command('status', paths)
+
+    def commit(self, paths=None):
+        self.run_command('commit', paths)
+
+    def sync(self, paths=None):
+        self.run_command('synch', paths)
 
     def log(self, path=None):
-        path = os.path.relpath(path, self.root_dir)
-        args = [self.path, 'log', '--nofork', path]
-        ForkGui(args, self.root_dir)
+        self.run_command('log', path)
 
     def blame(self, path=None):
-        path = os.path.relpath(path, self.root_dir)
-        args = [self.path, 'blame', '--nofork', path]
-        ForkGui(args, self.root_dir)
+        self.run_command('blame', path)
 
     def diff(self, path):
-        path = os.path.relpath(path, self.root_dir)
-        args = [self.path, 'vdiff', '--nofork', path]
-        ForkGui(args, self.root_dir)
+        self.run_command('vdiff', path)
 
-    def add(self, path):
-        path = os.path.relpath(path, self.root_dir)
-        args = [self.path, 'add', '--nofork', path]
-        ForkGui(args, self.root_dir)
+    def add(self, paths):
+        self.run_command('add', paths)
 
-    def remove(self, path):
-        path = os.path.relpath(path, self.root_dir)
-        args = [self.path, 'remove', '--nofork', path]
-        ForkGui(args, self.root_dir)
+    def remove(self, paths):
+        self.run_command('remove', paths)
 
-    def revert(self, path):
-        path = os.path.relpath(path, self.root_dir)
-        args = [self.path, 'revert', '--nofork', path]
-        ForkGui(args, self.root_dir)
+    def revert(self, paths):
+        self.run_command('revert', paths)
 
-    def get_status(self, path):
-        hg = Hg(self.path, self.root_dir)
-        return self.process_status(hg, path)
+    def get_backend(self):
+        if not hasattr(self, 'hg'):
+            self.hg = Hg(get_config().hg_path, self.root_dir)
+        return self.hg
 
 
 class NonInteractiveProcess():
-    def __init__(self, args, cwd=None):
+    # The number of seconds after which a process is killed
+    timeout = 60
+
+    def __init__(self, args, cwd=None, merge_errors=True):
         self.args = args
         self.cwd  = cwd
+        # Errors are discarded for output that has to be well-formed
+        self.merge_errors = merge_errors
+
+    def execute(self):
+        return '\n'.join(self.iter_records()).rstrip(' \n\r')
+
+    def stream(self, parse, separator='\n', key=None):
+        """
+        Runs the process and returns the result of calling parse with an
+        iterator over the records of its output. Concurrent calls share one
+        run only if they pass the same parse function, or the same key.
+        """
+        command = tuple(self.args) + (separator, key if key != None else
+            parse)
+        return process_scheduler.run(self.cwd, command,
+            lambda: parse(self.iter_records(separator)))
+
+    def find(self, matcher, separator='\n'):
+        """
+        Returns the first output record matcher returns True for, or None.
+        The process is killed as soon as the record has been found.
+        """
+        def find_record(records):
+            for record in records:
+                if matcher(record):
+                    return record
+            return None
+        return self.stream(find_record, separator, ('find', matcher))
+
+    def iter_records(self, separator='\n'):
+        """
+        Runs the process and yields its output one record at a time as it
+        is written. The process is killed when iteration stops early or when
+        it runs for longer than timeout seconds, otherwise it is waited for
+        once its output ends. Raises ProcessError if it exits with a
+        non-zero status, so that its error output is never parsed as a
+        result.
+        """
+        name = get_command_name(self.args)
+        start_time = time.time()
+        if self.merge_errors:
+            stderr = subprocess.STDOUT
+        else:
+            stderr = open(os.devnull, 'w')
+        try:
+            proc = subprocess.Popen(self.args, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=stderr,
+                startupinfo=get_startupinfo(), cwd=self.cwd)
+        finally:
+            if not self.merge_errors:
+                stderr.close()
+        proc.stdin.close()
+        metrics.observe('process.spawn ' + name, time.time() - start_time)
+
+        timed_out = []
+        def kill():
+            timed_out.append(True)
+            self.kill(proc)
+        timer = threading.Timer(self.timeout, kill)
+        timer.daemon = True
+        timer.start()
 
-    def run(self):
-        startupinfo = None
-        if os.name == 'nt':
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        try:
+            buffer = ''
+            while True:
+                chunk = os.read(proc.stdout.fileno(), 65536)
+                if not chunk:
+                    break
+                metrics.count('process.bytes_read ' + name, len(chunk))
+                records = (buffer + chunk).split(separator)
+                buffer = records.pop()
+                for record in records:
+                    yield record.rstrip('\r') if separator == '\n' else record
+            # The process is exiting once it has closed its output
+            proc.wait()
+            if timed_out:
+                raise ProcessTimeoutError('%s did not finish within %d ' %
+                    (os.path.basename(self.args[0]), self.timeout) +
+                    'seconds')
+            if proc.returncode != 0:
+                raise ProcessError('%s failed with exit status %d' % (name,
+                    proc.returncode), proc.returncode)
+            if buffer:
+                yield buffer.rstrip('\r') if separator == '\n' else buffer
+        finally:
+            timer.cancel()
+            if proc.returncode == None:
+                self.kill(proc)
+            proc.stdout.close()
+            metrics.observe('process.run ' + name, time.time() - start_time)
+            metrics.count('process.exit %s %s' % (name, proc.returncode))
+
+    def kill(self, proc):
+        try:
+            if proc.poll() == None:
+                proc.kill()
+            proc.wait()
+        except (OSError):
+            pass
 
-        proc = subprocess.Popen(self.args, stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-            startupinfo=startupinfo, cwd=self.cwd)
 
-        return proc.stdout.read().replace('\r\n', '\n').rstrip(' \n\r')
+class RecordReader():
+    """
+    A file-like view of an iterator over output records, for parsers that
+    read from files
+    """
+    def __init__(self, records, separator):
+        self.records = records
+        self.separator = separator
 
+    def read(self, size=-1):
+        for record in self.records:
+            return record + self.separator
+        return ''
 
-class SVN():
-    def __init__(self, root_dir):
-        self.root_dir = root_dir
 
-    def check_status(self, path):
-        svn_path = os.path.join(sublime.packages_path(), __name__, 'svn',
-            'svn.exe')
-        proc = NonInteractiveProcess([svn_path, 'status', path],
-            cwd=self.root_dir)
-        result = proc.run().split('\n')
-        for line in result:
-            if len(line) < 1:
-                continue
+class InFlightProcess():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ProcessScheduler():
+    """
+    Runs VCS processes so that concurrent identical requests for the same
+    repository share a single execution, and caps the number of processes
+    running at once per repository and in total. Requests over the caps
+    wait in a queue.
+    """
+    def __init__(self, max_processes, max_processes_per_root):
+        self.max_processes = max_processes
+        self.max_processes_per_root = max_processes_per_root
+        self.condition = threading.Condition()
+        self.in_flight = {}
+        self.running = 0
+        self.running_per_root = {}
+        self.queued = 0
+        self.max_queued = 0
+        self.runs = 0
+        self.shared = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def run(self, root_dir, command, fn):
+        """
+        Calls fn to run command in root_dir, or waits for the identical
+        execution already in progress and returns its result
+        """
+        key = (root_dir, command)
+        self.condition.acquire()
+        try:
+            flight = self.in_flight.get(key)
+            owner = flight == None
+            if owner:
+                flight = InFlightProcess()
+                self.in_flight[key] = flight
+                self.acquire_slot(root_dir)
+            else:
+                self.shared += 1
+        finally:
+            self.condition.release()
 
-            path_without_root = path.replace(self.root_dir + '\\', '', 1)
-            path_regex = re.escape(path_without_root) + '$'
-            if self.root_dir != path and re.search(path_regex, line) == None:
+        if not owner:
+            flight.done.wait()
+            if flight.error != None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except (Exception) as (exception):
+            flight.error = exception
+            raise
+        finally:
+            self.condition.acquire()
+            try:
+                del self.in_flight[key]
+                self.release_slot(root_dir)
+            finally:
+                self.condition.release()
+            flight.done.set()
+
+    def acquire_slot(self, root_dir):
+        start_time = time.time()
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        while self.running >= self.max_processes or \
+                self.running_per_root.get(root_dir, 0) >= \
+                self.max_processes_per_root:
+            self.condition.wait()
+        self.queued -= 1
+        self.running += 1
+        self.running_per_root[root_dir] = \
+            self.running_per_root.get(root_dir, 0) + 1
+
+        wait = time.time() - start_time
+        self.runs += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def release_slot(self, root_dir):
+        self.running -= 1
+        self.running_per_root[root_dir] -= 1
+        if not self.running_per_root[root_dir]:
+            del self.running_per_root[root_dir]
+        self.condition.notifyAll()
+
+    def stats(self):
+        self.condition.acquire()
+        try:
+            return {
+                'running': self.running,
+                'queued': self.queued,
+                'max_queued': self.max_queued,
+                'runs': self.runs,
+                'shared': self.shared,
+                'total_wait': self.total_wait,
+                'max_wait': self.max_wait,
+                'average_wait': self.total_wait / self.runs if self.runs
+                    else 0.0
+            }
+        finally:
+            self.condition.release()
+
+
+process_scheduler = ProcessScheduler(4, 2)
+
+
+def get_command_name(args):
+    """
+    Returns the executable and subcommand of args, e.g. "git status", to
+    group metrics by
+    """
+    name = os.path.basename(args[0])
+    if name.lower().endswith('.exe'):
+        name = name[:-4]
+    for arg in args[1:]:
+        if not arg.startswith('-'):
+            return name + ' ' + arg
+    return name
+
+
+def get_startupinfo():
+    startupinfo = None
+    if os.name == 'nt':
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    return startupinfo
+
+
+class PersistentProcess():
+    """
+    A long-running helper process that answers requests written to its
+    stdin. It is started on the first request, restarted if it dies and
+    stopped after idle_timeout seconds without requests. Requests are
+    serialized, so responses are read in the order requests were sent.
+    """
+    def __init__(self, args, cwd, idle_timeout, env=None):
+        self.args = args
+        self.cwd = cwd
+        self.idle_timeout = idle_timeout
+        self.env = env
+        self.proc = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        start_time = time.time()
+        devnull = open(os.devnull, 'w')
+        try:
+            self.proc = subprocess.Popen(self.args, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=devnull,
+                startupinfo=get_startupinfo(), cwd=self.cwd, env=self.env)
+        finally:
+            devnull.close()
+        self.handshake()
+        metrics.observe('helper.start ' + get_command_name(self.args),
+            time.time() - start_time)
+
+    def handshake(self):
+        pass
+
+    def stop(self):
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+        if self.proc != None:
+            try:
+                self.proc.stdin.close()
+                if self.proc.poll() == None:
+                    self.proc.kill()
+                self.proc.wait()
+            except (IOError, OSError):
+                pass
+            self.proc = None
+
+    def kill(self, timed_out):
+        timed_out.append(True)
+        proc = self.proc
+        if proc != None:
+            try:
+                proc.kill()
+            except (OSError):
+                pass
+
+    def stop_if_unused(self):
+        """
+        Stops the process unless a request is in progress, without waiting
+        for it to finish
+        """
+        if not self.lock.acquire(False):
+            return
+        try:
+            self.stop()
+        finally:
+            self.lock.release()
+
+    def stop_if_idle(self, timer):
+        self.lock.acquire()
+        try:
+            if self.timer == timer:
+                self.stop()
+        finally:
+            self.lock.release()
+
+    def request(self, *args):
+        """
+        Sends a request through communicate(), restarting the process and
+        retrying once if it has crashed
+        """
+        start_time = time.time()
+        self.lock.acquire()
+        try:
+            if self.timer != None:
+                self.timer.cancel()
+            # A helper that hangs is killed like any other VCS process
+            timed_out = []
+            deadline = threading.Timer(NonInteractiveProcess.timeout,
+                lambda: self.kill(timed_out))
+            deadline.daemon = True
+            deadline.start()
+            try:
+                try:
+                    if self.proc == None or self.proc.poll() != None:
+                        self.stop()
+                        self.start()
+                    result = self.communicate(*args)
+                except (IOError, OSError, struct.error):
+                    if timed_out:
+                        raise
+                    metrics.count('helper.restarts ' +
+                        get_command_name(self.args))
+                    self.stop()
+                    self.start()
+                    result = self.communicate(*args)
+            except (IOError, OSError, struct.error):
+                if timed_out:
+                    raise ProcessTimeoutError('%s did not answer within %d ' %
+                        (os.path.basename(self.args[0]),
+                        NonInteractiveProcess.timeout) + 'seconds')
+                raise
+            finally:
+                deadline.cancel()
+
+            timer = threading.Timer(self.idle_timeout,
+                lambda: self.stop_if_idle(timer))
+            timer.daemon = True
+            timer.start()
+            self.timer = timer
+            return result
+        except:
+            self.stop()
+            metrics.count('helper.errors ' + get_command_name(self.args))
+            raise
+        finally:
+            self.lock.release()
+            metrics.observe('helper.request ' + get_command_name(self.args),
+                time.time() - start_time)
+
+    def communicate(self, *args):
+        """
+        Writes a request to the running process and returns the response.
+        Every helper implements it for its own protocol.
+        """
+        raise NotImplementedError()
+
+    def read_exactly(self, length):
+        data = self.proc.stdout.read(length)
+        if len(data) < length:
+            raise IOError('%s exited unexpectedly' % self.args[0])
+        return data
+
+    def read_until(self, separator):
+        data = []
+        while True:
+            char = self.read_exactly(1)
+            if char == separator:
+                return ''.join(data)
+            data.append(char)
+
+
+class StatusRequest():
+    # Requests from menus are served before background prefetches
+    INTERACTIVE = 0
+    PREFETCH = 1
+
+    def __init__(self, vcs, paths, fingerprint, signatures, cache_length,
+            debug, priority=INTERACTIVE):
+        self.vcs = vcs
+        self.paths = paths
+        self.fingerprint = fingerprint
+        self.signatures = signatures
+        self.cache_length = cache_length
+        self.debug = debug
+        self.priority = priority
+        self.key = (vcs.root_dir, tuple(paths))
+
+
+class StatusService():
+    """
+    Runs VCS status commands on a background thread so that menu predicates
+    never wait for them. Results are published to the status cache on the UI
+    thread through sublime.set_timeout().
+    """
+    # Seconds to skip prefetches of a working copy after one failed, doubled
+    # after every further failure
+    min_backoff = 30
+    max_backoff = 600
+
+    def __init__(self):
+        self.queue = Queue.PriorityQueue()
+        self.pending = {}
+        # root_dir -> [number of failed prefetches, time to retry at]
+        self.failures = {}
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def request(self, request):
+        self.lock.acquire()
+        try:
+            failure = self.failures.get(request.vcs.root_dir)
+            if request.priority == StatusRequest.PREFETCH and \
+                    failure != None and failure[1] > time.time():
+                return
+            # A pending request is only queued again when it is now needed
+            # more urgently, e.g. a menu opened while it was being prefetched
+            if request.key in self.pending and \
+                    self.pending[request.key] <= request.priority:
+                return
+            self.pending[request.key] = request.priority
+            self.sequence += 1
+            sequence = self.sequence
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.work)
+                self.thread.daemon = True
+                self.thread.start()
+        finally:
+            self.lock.release()
+        self.queue.put((request.priority, sequence, request))
+
+    def work(self):
+        while True:
+            priority, sequence, request = self.queue.get()
+            try:
+                self.process(request)
+            finally:
+                self.lock.acquire()
+                if self.pending.get(request.key) == priority:
+                    del self.pending[request.key]
+                self.lock.release()
+
+    def process(self, request):
+        start_time = time.time()
+        snapshot = status_cache.get_snapshot(request.vcs.root_dir)
+        try:
+            statuses = request.vcs.check_statuses(request.paths,
+                request.fingerprint, request.cache_length)
+        except (Exception) as (exception):
+            metrics.count('status.errors ' + request.vcs.__class__.__name__)
+            message = str(exception)
+            if request.priority == StatusRequest.INTERACTIVE:
+                sublime.set_timeout(lambda: sublime.error_message(message), 0)
+            else:
+                # Prefetches run whenever a file is focused, so a broken
+                # working copy must not bring up a dialog every time
+                delay = self.back_off(request.vcs.root_dir)
+                print 'Tortoise: Unable to prefetch the status of %s, ' \
+                    'retrying in %d seconds: %s' % (request.vcs.root_dir,
+                    delay, message)
+            return
+        self.lock.acquire()
+        self.failures.pop(request.vcs.root_dir, None)
+        self.lock.release()
+        metrics.observe('status.refresh ' + request.vcs.__class__.__name__,
+            time.time() - start_time)
+
+        new_snapshot = status_cache.get_snapshot(request.vcs.root_dir)
+        if request.debug and new_snapshot not in [None, snapshot]:
+            print 'Status snapshot of %(root_dir)s: %(entries)d paths in ' \
+                '%(bytes)d bytes, %(dict_bytes)d bytes as a dict' % \
+                dict(new_snapshot.statuses.footprint(request.vcs.root_dir),
+                    root_dir=request.vcs.root_dir)
+
+        def publish():
+            for i in range(len(request.paths)):
+                status_cache.set(request.vcs.root_dir, request.paths[i],
+                    statuses[i], request.fingerprint, request.signatures[i],
+                    request.cache_length)
+            if request.debug:
+                print 'Status cache: %(entries)d entries, %(hits)d hits, ' \
+                    '%(misses)d misses, %(evictions)d evictions' % \
+                    status_cache.stats()
+                print 'VCS processes: %(runs)d run, %(shared)d shared, ' \
+                    '%(queued)d queued, %(average_wait).3f seconds ' \
+                    'average wait' % process_scheduler.stats()
+        sublime.set_timeout(publish, 0)
+
+        if request.debug:
+            print 'Fetching status for %s in %s seconds' % (
+                ', '.join(request.paths), str(time.time() - start_time))
+
+    def back_off(self, root_dir):
+        """
+        Records a failed prefetch of root_dir, returning the number of seconds
+        until it is prefetched again
+        """
+        self.lock.acquire()
+        try:
+            count = self.failures.get(root_dir, [0])[0] + 1
+            delay = min(self.min_backoff * 2 ** (count - 1), self.max_backoff)
+            self.failures[root_dir] = [count, time.time() + delay]
+            return delay
+        finally:
+            self.lock.release()
+
+
+status_service = StatusService()
+
+
+def stat_signature(path):
+    try:
+        stat = os.stat(path)
+    except (OSError):
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+class StatusStore(object):
+    """
+    A compact map of root-relative paths to single character status codes.
+    Paths are kept as tuples of interned components in a sorted list, with
+    the codes in a parallel bytearray, so lookups are binary searches and
+    all of the paths within a directory form one contiguous range. Lookups
+    ignore case where the file system does, and the paths whose case that
+    changes are kept as the VCS reported them for display.
+    """
+    __slots__ = ['keys', 'codes', 'components', 'names', 'lock', 'version']
+
+    def __init__(self, statuses):
+        self.components = {}
+        self.names = {}
+        self.lock = threading.Lock()
+        # Incremented on every change, so that lists built from the store
+        # can tell whether they are outdated
+        self.version = 0
+        codes = {}
+        for key, status in statuses.iteritems():
+            if not status:
                 continue
+            key = self.decode(key)
+            parts = self.split(key)
+            if os.sep.join(parts) != key:
+                self.names[parts] = key
+            codes[parts] = str(status[0])
+        items = sorted(codes.items())
+        self.keys = [key for key, code in items]
+        self.codes = bytearray(''.join([code for key, code in items]))
+
+    def decode(self, key):
+        if isinstance(key, str):
+            try:
+                return key.decode('utf-8')
+            except (UnicodeDecodeError):
+                return key.decode('latin-1')
+        return key
+
+    def split(self, key):
+        key = os.path.normcase(self.decode(key))
+        if key in ['', '.']:
+            return ()
+        parts = []
+        for part in key.split(os.sep):
+            parts.append(self.components.setdefault(part, part))
+        return tuple(parts)
+
+    def find(self, parts):
+        i = bisect.bisect_left(self.keys, parts)
+        if i < len(self.keys) and self.keys[i] == parts:
+            return i
+        return None
+
+    def get_range(self, parts):
+        """
+        Returns the range of indexes of parts and of the paths within it
+        """
+        lo = bisect.bisect_left(self.keys, parts)
+        if not parts:
+            return (lo, len(self.keys))
+        hi = bisect.bisect_left(self.keys, parts[:-1] + (parts[-1] + '\0',),
+            lo)
+        return (lo, hi)
+
+    def get(self, key):
+        parts = self.split(key)
+        self.lock.acquire()
+        try:
+            i = self.find(parts)
+            return chr(self.codes[i]) if i != None else None
+        finally:
+            self.lock.release()
+
+    def set(self, key, status):
+        parts = self.split(key)
+        self.lock.acquire()
+        try:
+            i = self.find(parts)
+            code = ord(status[0])
+            if i != None:
+                if self.codes[i] == code:
+                    return
+                self.codes[i] = code
+            else:
+                i = bisect.bisect_left(self.keys, parts)
+                self.keys.insert(i, parts)
+                self.codes.insert(i, code)
+            self.version += 1
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        parts = self.split(key)
+        self.lock.acquire()
+        try:
+            i = self.find(parts)
+            if i != None:
+                del self.keys[i]
+                del self.codes[i]
+                self.names.pop(parts, None)
+                self.version += 1
+        finally:
+            self.lock.release()
+
+    def get_codes(self, key):
+        """
+        Returns the status codes of a path and of every path within it
+        """
+        self.lock.acquire()
+        try:
+            lo, hi = self.get_range(self.split(key))
+            return self.codes[lo:hi]
+        finally:
+            self.lock.release()
+
+    def iteritems(self, key='.'):
+        """
+        Yields the paths, as the VCS reported them, and the statuses of a
+        path and of every path within it
+        """
+        self.lock.acquire()
+        try:
+            lo, hi = self.get_range(self.split(key))
+            keys = self.keys[lo:hi]
+            codes = self.codes[lo:hi]
+        finally:
+            self.lock.release()
+        for i in range(len(keys)):
+            name = self.names.get(keys[i])
+            if name == None:
+                name = os.sep.join(keys[i])
+            yield (name, chr(codes[i]))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def footprint(self, root_dir):
+        """
+        Returns the approximate number of bytes used by the store, and the
+        number that a dict of absolute paths to status dicts would use
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.keys) + \
+            sys.getsizeof(self.codes) + sys.getsizeof(self.components) + \
+            sys.getsizeof(self.names)
+        for key in self.keys:
+            size += sys.getsizeof(key)
+        for component in self.components:
+            size += sys.getsizeof(component)
+        for name in self.names.itervalues():
+            size += sys.getsizeof(name)
+
+        dict_size = sys.getsizeof(dict.fromkeys(xrange(len(self.keys))))
+        entry_size = sys.getsizeof({'time': 0.0, 'status': 'M'}) + \
+            sys.getsizeof(0.0)
+        for key in self.keys:
+            dict_size += entry_size + sys.getsizeof(os.path.join(root_dir,
+                *key))
+        return {'entries': len(self.keys), 'bytes': size,
+            'dict_bytes': dict_size}
+
+
+class StatusSnapshot():
+    """
+    The status of every changed path within a working copy, as reported by a
+    single run of the VCS status command. Paths that are not listed are clean.
+    """
+    def __init__(self, root_dir, statuses, start_time, fingerprint):
+        self.root_dir = root_dir
+        self.statuses = StatusStore(statuses)
+        self.time = start_time
+        self.fingerprint = fingerprint
+        # Paths queried individually since, with the time the query started
+        self.checked = {}
+
+    def key(self, path):
+        return os.path.normcase(os.path.normpath(os.path.relpath(path,
+            self.root_dir)))
+
+    def is_fresh(self, path, fingerprint, cache_length):
+        if fingerprint == None:
+            return self.time > time.time() - cache_length
+        if fingerprint != self.fingerprint:
+            return False
 
-            return line[0]
+        # Edits to the working file do not touch the VCS metadata, so the
+        # file must also be unchanged since the status command started
+        signature = stat_signature(path)
+        key = self.key(path)
+        if signature == None:
+            return self.statuses.get(key) != None
+        return signature[0] < self.checked.get(key, self.time)
+
+    def update(self, path, status, start_time):
+        key = self.key(path)
+        if status:
+            self.statuses.set(key, status)
+        else:
+            self.statuses.remove(key)
+        self.checked[key] = start_time
+
+    def get_dir_status(self, path):
+        """
+        Returns the status of a directory rolled up from the statuses of the
+        paths within it: '?' if it is unversioned, 'C' if it contains
+        conflicts, 'M' if it contains other changes, or the status reported
+        for the directory itself
+        """
+        status = self.get(path)
+        if status != '':
+            return status
+
+        codes = self.statuses.get_codes(self.key(path))
+        if 'C' in codes or 'U' in codes:
+            return 'C'
+        if codes.translate(None, '?IX'):
+            return 'M'
         return ''
 
+    def get(self, path):
+        key = self.key(path)
+        status = self.statuses.get(key)
+        if status != None:
+            return status
+
+        # Unversioned directories are reported once instead of per file
+        parent = os.path.dirname(key)
+        while parent:
+            if self.statuses.get(parent) == '?':
+                return '?'
+            parent = os.path.dirname(parent)
+        return ''
 
-class Git():
-    def __init__(self, tortoise_proc_path, root_dir):
-        settings = sublime.load_settings('Tortoise.sublime-settings')
-        self.git_path = settings.get('git_tgit_path') or (os.path.dirname(tortoise_proc_path) + '\\tgit.exe')
+
+class SnapshotStore():
+    """
+    Persists the latest status snapshot of every working copy to the cache
+    directory, so that it is available right after the editor starts. A
+    stored snapshot is only fresh if neither the metadata fingerprint nor
+    the revision of the working copy changed since it was written, otherwise
+    it is only used until a refresh finishes.
+    """
+    header = 'Tortoise status snapshot 3\n'
+
+    def __init__(self):
+        self.enabled = True
+        self.directory = None
+
+    def configure(self, config):
+        self.enabled = config.persistent_cache
+        if self.directory == None:
+            # Sublime Text 2 has no cache directory of its own
+            self.directory = os.path.join(os.path.dirname(
+                sublime.packages_path()), 'Cache', 'Tortoise')
+
+    def get_path(self, root_dir):
+        if isinstance(root_dir, unicode):
+            root_dir = root_dir.encode('utf-8')
+        return os.path.join(self.directory,
+            hashlib.sha1(root_dir).hexdigest() + '.status')
+
+    def load(self, root_dir, fingerprint, revision):
+        if not self.enabled or self.directory == None:
+            return None
+        try:
+            with open(self.get_path(root_dir), 'rb') as f:
+                if f.readline() != self.header:
+                    return None
+                same_fingerprint = f.readline() == repr(fingerprint) + '\n'
+                same_revision = f.readline() == repr(revision) + '\n'
+                start_time = float(f.readline())
+                records = f.read().split('\0')
+        except (IOError, ValueError):
+            return None
+
+        statuses = {}
+        try:
+            for record in records[:-1]:
+                status, key = record.split('\t', 1)
+                try:
+                    key = key.decode('utf-8')
+                except (UnicodeDecodeError):
+                    pass
+                statuses[key] = status
+        except (ValueError):
+            return None
+
+        # A stale snapshot matches no fingerprint, so the first lookup
+        # refreshes it while menus show the statuses it has. Commands like
+        # git add change statuses without touching the files, so a changed
+        # fingerprint always means a full refresh.
+        fresh = same_fingerprint and same_revision
+        return StatusSnapshot(root_dir, statuses, start_time,
+            fingerprint if fresh else None)
+
+    def save(self, snapshot, revision):
+        if not self.enabled or self.directory == None:
+            return
+        path = self.get_path(snapshot.root_dir)
+        temp_path = path + '.tmp'
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            f = open(temp_path, 'wb')
+            try:
+                f.write(self.header)
+                f.write(repr(snapshot.fingerprint) + '\n')
+                f.write(repr(revision) + '\n')
+                f.write(repr(snapshot.time) + '\n')
+                for key, status in snapshot.statuses.iteritems():
+                    if isinstance(key, unicode):
+                        key = key.encode('utf-8')
+                    f.write(status + '\t' + key + '\0')
+            finally:
+                f.close()
+            # Windows can not rename over an existing file
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        except (EnvironmentError) as (exception):
+            print 'Tortoise: Unable to save the status snapshot of %s: %s' % \
+                (snapshot.root_dir, str(exception))
+
+
+snapshot_store = SnapshotStore()
+
+
+class QueryPlanner():
+    """
+    Decides, per working copy, whether statuses missing from the snapshot
+    should be queried for just the requested paths or by refreshing the
+    whole snapshot. Scoped queries cost their measured latency for every
+    lookup expected before the snapshot goes stale again, estimated from the
+    recent lookup rate, while a refresh costs its measured latency once.
+    """
+    # Seconds of lookups the query rate is measured over
+    window = 60
+    # Weight of the latest measurement in the moving averages
+    weight = 0.3
+    # Latencies assumed until measured, per query and per tracked file
+    default_scoped_latency = 0.05
+    default_file_latency = 0.00002
+
+    def __init__(self, root_dir):
         self.root_dir = root_dir
+        self.scoped_latency = None
+        self.full_latency = None
+        self.lookups = []
+        self.lifetime = None
+        self.fingerprint = None
+        self.changed = time.time()
+
+    def average(self, average, value):
+        if average == None:
+            return value
+        return average + self.weight * (value - average)
+
+    def record_scoped(self, latency):
+        self.scoped_latency = self.average(self.scoped_latency, latency)
+
+    def record_full(self, latency):
+        self.full_latency = self.average(self.full_latency, latency)
+
+    def plan(self, count, fingerprint, cache_length, size):
+        """
+        Returns 'scoped' or 'full' for a lookup of count paths
+        """
+        now = time.time()
+        self.lookups = [lookup for lookup in self.lookups if
+            lookup > now - self.window]
+        self.lookups.extend([now] * count)
+
+        # Snapshots stay fresh until the metadata changes, or for the TTL
+        if fingerprint == None:
+            lifetime = cache_length
+        else:
+            if fingerprint != self.fingerprint:
+                if self.fingerprint != None:
+                    self.lifetime = self.average(self.lifetime,
+                        now - self.changed)
+                self.fingerprint = fingerprint
+                self.changed = now
+            lifetime = self.lifetime if self.lifetime != None else \
+                self.window
+        expected = max(count, len(self.lookups) * lifetime /
+            float(self.window))
+
+        scoped_latency = self.scoped_latency
+        if scoped_latency == None:
+            scoped_latency = self.default_scoped_latency
+        full_latency = self.full_latency
+        if full_latency == None:
+            full_latency = self.default_scoped_latency * 10
+            if size != None:
+                full_latency = self.default_scoped_latency + \
+                    size * self.default_file_latency
+
+        plan = 'full' if full_latency < scoped_latency * expected else \
+            'scoped'
+        if get_config().debug:
+            print ('Query plan for %s: %s, scoped %.3f seconds x %.1f ' +
+                'expected lookups, full %.3f seconds for %s files') % (
+                self.root_dir, plan, scoped_latency, expected, full_latency,
+                size if size != None else 'unknown')
+        return plan
+
+
+class VCS():
+    metadata_files = []
+    # The number of paths passed to one status command, which keeps the
+    # command line within the 32768 characters Windows allows
+    batch_size = 100
+
+    def stop(self):
+        """
+        Stops the idle helper processes of the VCS and closes the metadata
+        it keeps open. A helper that is busy with a request stops once its
+        idle timeout expires instead.
+        """
+        pass
+
+    def get_fingerprint(self):
+        """
+        Returns the stat signatures of the files the VCS rewrites whenever
+        the status of the working copy changes, or None if there are none
+        """
+        paths = self.get_metadata_paths()
+        if not paths:
+            return None
+        return tuple([stat_signature(path) for path in paths])
+
+    def get_metadata_paths(self):
+        return [os.path.join(self.root_dir, name) for name in
+            self.metadata_files]
+
+    def get_revision(self):
+        """
+        Returns the revision the working copy is based on when it is not
+        already part of the metadata fingerprint, otherwise None
+        """
+        return None
+
+    def get_size(self):
+        """
+        Returns the number of tracked files if it is cheap to find out,
+        otherwise None
+        """
+        return None
+
+    def get_base(self, path):
+        """
+        Returns a tuple of the id and the lines of the content path has in
+        the revision the working copy is based on, or None if it has none
+        """
+        base_id = self.get_base_id(path)
+        if base_id == None:
+            return None
+        lines = base_cache.get(base_id)
+        if lines == None:
+            content = self.read_base(path, base_id)
+            if content == None:
+                return None
+            try:
+                content = content.decode('utf-8')
+            except (UnicodeDecodeError):
+                content = content.decode('latin-1')
+            lines = content.replace('\r\n', '\n').split('\n')
+            base_cache.set(base_id, lines)
+        return (base_id, lines)
+
+    def get_base_id(self, path):
+        return None
+
+    def read_base(self, path, base_id):
+        return None
+
+    def get_base_revision(self, path):
+        """
+        Returns the revision the base content of path was blamed at, if the
+        base id does not already identify it
+        """
+        return self.get_revision()
+
+    def get_blame(self, path, base_id):
+        """
+        Returns a list of tuples of the revision and the author of every
+        line of the base content of path
+        """
+        key = (self.root_dir, path, self.get_base_revision(path), base_id)
+        blame = blame_cache.get(key)
+        if blame == None:
+            blame = self.read_blame(path)
+            # Failures are not cached, so that blame runs again next time
+            if blame:
+                blame_cache.set(key, blame)
+        return blame
+
+    def read_blame(self, path):
+        return None
+
+    def get_planner(self):
+        if not hasattr(self, 'planner'):
+            self.planner = QueryPlanner(self.root_dir)
+        return self.planner
+
+    def get_cached_snapshot(self):
+        """
+        Returns the latest snapshot, loading the stored one the first time
+        the working copy is looked at
+        """
+        snapshot = status_cache.get_snapshot(self.root_dir)
+        if snapshot == None and not hasattr(self, 'loaded_snapshot'):
+            self.loaded_snapshot = True
+            fingerprint = self.get_fingerprint()
+            snapshot = snapshot_store.load(self.root_dir, fingerprint,
+                self.get_revision() if fingerprint != None else None)
+            if snapshot != None:
+                status_cache.set_snapshot(self.root_dir, snapshot)
+        return snapshot
+
+    def get_fresh_snapshot(self, path, fingerprint, cache_length):
+        snapshot = self.get_cached_snapshot()
+        if snapshot != None and snapshot.is_fresh(path, fingerprint,
+                cache_length):
+            return snapshot
+        return None
+
+    def check_statuses(self, paths, fingerprint, cache_length):
+        """
+        Returns the statuses of paths, answering them all from a single
+        snapshot when more than one path is requested
+        """
+        if len(paths) == 1:
+            return [self.check_status(paths[0], fingerprint, cache_length)]
+
+        snapshot = self.get_cached_snapshot()
+        if snapshot == None or [path for path in paths if not
+                snapshot.is_fresh(path, fingerprint, cache_length)]:
+            # Directory statuses are rolled up from a whole snapshot
+            if not [path for path in paths if os.path.isdir(path)] and \
+                    self.get_planner().plan(len(paths), fingerprint,
+                    cache_length, self.get_size()) == 'scoped':
+                statuses = self.query_file_statuses(paths)
+                if None not in statuses:
+                    return statuses
+            snapshot = self.refresh_snapshot(fingerprint)
+
+        statuses = []
+        for path in paths:
+            if os.path.isdir(path):
+                statuses.append(self.get_dir_status(snapshot, path))
+            else:
+                statuses.append(snapshot.get(path))
+        return statuses
+
+    def get_snapshot(self, path, fingerprint, cache_length):
+        snapshot = self.get_fresh_snapshot(path, fingerprint, cache_length)
+        if snapshot != None:
+            return snapshot
+        return self.refresh_snapshot(fingerprint)
+
+    def get_file_status(self, path, fingerprint, cache_length):
+        """
+        Returns the status of a file from the snapshot, querying the file on
+        its own or refreshing the snapshot if it is not fresh
+        """
+        snapshot = self.get_fresh_snapshot(path, fingerprint, cache_length)
+        if snapshot != None:
+            return snapshot.get(path)
+
+        # When only the file itself was modified since the snapshot was taken
+        # its status can be queried on its own
+        snapshot = self.get_cached_snapshot()
+        if snapshot != None and fingerprint != None and \
+                snapshot.fingerprint == fingerprint:
+            start_time = time.time()
+            # Modifying an unversioned file does not change its status
+            status = snapshot.get(path)
+            if status != '?':
+                status = self.query_file_status(path)
+            if status != None:
+                snapshot.update(path, status, start_time)
+                return status
+        elif self.get_planner().plan(1, fingerprint, cache_length,
+                self.get_size()) == 'scoped':
+            status = self.query_file_status(path)
+            if status != None:
+                return status
+        return self.refresh_snapshot(fingerprint).get(path)
+
+    def query_file_status(self, path):
+        """
+        Returns the status of a file from a status command run for just that
+        file, or None if only the status of the whole working copy can tell
+        """
+        start_time = time.time()
+        status = self.query_status(path)
+        self.get_planner().record_scoped(time.time() - start_time)
+        return self.check_scoped_status(status)
+
+    def query_file_statuses(self, paths):
+        """
+        Returns the statuses of paths from status commands run for just
+        those paths, in batches that fit on a command line. Statuses only
+        the status of the whole working copy can tell are None.
+        """
+        statuses = []
+        for i in range(0, len(paths), self.batch_size):
+            batch = paths[i:i + self.batch_size]
+            start_time = time.time()
+            batch_statuses = self.read_statuses([os.path.relpath(path,
+                self.root_dir) for path in batch])
+            self.get_planner().record_scoped(time.time() - start_time)
+            # Files within unversioned directories are listed as the
+            # directory
+            snapshot = StatusSnapshot(self.root_dir, batch_statuses,
+                start_time, None)
+            statuses.extend([self.check_scoped_status(snapshot.get(path))
+                for path in batch])
+        return statuses
+
+    def check_scoped_status(self, status):
+        """
+        Returns a status reported by a status command run for some paths
+        only, or None if it may differ in the status of the whole working
+        copy
+        """
+        return status
+
+    def refresh_snapshot(self, fingerprint):
+        start_time = time.time()
+        statuses = self.read_statuses()
+        self.get_planner().record_full(time.time() - start_time)
+        # Status commands may refresh the metadata, e.g. the git index, so
+        # the fingerprint is only taken once they have finished
+        if fingerprint != None:
+            fingerprint = self.get_fingerprint()
+        snapshot = StatusSnapshot(self.root_dir, statuses, start_time,
+            fingerprint)
+        status_cache.set_snapshot(self.root_dir, snapshot)
+        snapshot_store.save(snapshot,
+            self.get_revision() if fingerprint != None else None)
+        return snapshot
+
+    def check_dir_status(self, path, fingerprint, cache_length):
+        """
+        Returns the status of a directory from the snapshot, without walking
+        the history to find out whether it is versioned
+        """
+        return self.get_dir_status(self.get_snapshot(path, fingerprint,
+            cache_length), path)
+
+    def get_dir_status(self, snapshot, path):
+        status = snapshot.get_dir_status(path)
+        if status == '' and self.is_tracked_dir(path) == False:
+            return '?'
+        return status
+
+    def is_tracked_dir(self, path):
+        """
+        Returns if the VCS tracks anything within a directory, or None if
+        that can not be determined without running the VCS
+        """
+        return None
+
+    def get_names_prefix(self, path):
+        name = os.path.relpath(path, self.root_dir).replace(os.sep, '/')
+        return '' if name == '.' else name + '/'
+
+    def add_status(self, statuses, path, status):
+        # The case is kept for display, StatusStore ignores it in lookups
+        statuses[os.path.normpath(path.rstrip('/\\'))] = status
+
+    def get_key(self, path):
+        return os.path.normcase(os.path.normpath(path.rstrip('/\\')))
+
+    def get_path_matcher(self, path, start):
+        """
+        Returns a function that checks whether an output record of a status
+        command lists path, with the path starting at index start
+        """
+        key = self.get_key(os.path.relpath(path, self.root_dir))
+        return lambda record: len(record) > start and \
+            self.get_key(record[start:]) == key
+
+
+class SVNWorkingCopyDb():
+    """
+    A read-only connection to the .svn/wc.db of a Subversion 1.7+ working
+    copy, used to look up the recorded state of a node
+    """
+    conflict_columns = ['conflict_old', 'conflict_new', 'conflict_working',
+        'prop_reject', 'tree_conflict_data', 'conflict_data']
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        try:
+            self.connection.execute('PRAGMA query_only = ON')
+        except (sqlite3.Error):
+            pass
+
+        version = self.query('PRAGMA user_version')[0]['user_version']
+        if version < 29:
+            raise UnsupportedFormatError('Unsupported wc.db format %d' %
+                version)
+        self.wc_id = self.query('SELECT id FROM wcroot WHERE ' +
+            'local_abspath IS NULL')[0]['id']
+
+    def query(self, sql, params=()):
+        self.lock.acquire()
+        try:
+            cursor = self.connection.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        finally:
+            self.lock.release()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def get_nodes(self, relpath):
+        """
+        Returns the rows of the NODES table for relpath, the working layers
+        first and the BASE layer last
+        """
+        return self.query('SELECT op_depth, presence, kind, repos_id, ' +
+            'translated_size, last_mod_time FROM nodes WHERE wc_id = ? ' +
+            'AND local_relpath = ? ORDER BY op_depth DESC',
+            (self.wc_id, relpath))
+
+    def get_base_node(self, relpath):
+        """
+        Returns the checksum of the pristine copy and the revision of the
+        BASE node of relpath, or None
+        """
+        rows = self.query('SELECT checksum, revision FROM nodes WHERE ' +
+            'wc_id = ? AND local_relpath = ? AND op_depth = 0',
+            (self.wc_id, relpath))
+        return rows[0] if rows else None
+
+    def is_conflicted(self, relpath):
+        rows = self.query('SELECT * FROM actual_node WHERE wc_id = ? AND ' +
+            'local_relpath = ?', (self.wc_id, relpath))
+        for row in rows:
+            for column in self.conflict_columns:
+                if row.get(column) != None:
+                    return True
+        return False
+
+    def close(self):
+        # Queries only take milliseconds, so waiting for one is fine
+        self.lock.acquire()
+        try:
+            self.connection.close()
+        finally:
+            self.lock.release()
+
 
-    def check_status(self, path):
+class SVN(VCS):
+    metadata_files = [os.path.join('.svn', 'wc.db')]
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.svn_path = get_config().svn_path
+        self.db = None
+
+    def stop(self):
+        if self.db != None:
+            self.db.close()
+            self.db = None
+
+    # The status letters of the wc-status items of svn status --xml
+    xml_statuses = {
+        'added': 'A',
+        'conflicted': 'C',
+        'deleted': 'D',
+        'external': 'X',
+        'ignored': 'I',
+        'incomplete': '!',
+        'missing': '!',
+        'modified': 'M',
+        'obstructed': '~',
+        'replaced': 'R',
+        'unversioned': '?'
+    }
+
+    def read_statuses(self, names=None):
+        if ElementTree == None:
+            proc = NonInteractiveProcess([self.svn_path, 'status'] +
+                (names or []), cwd=self.root_dir)
+            return proc.stream(self.parse_statuses)
+
+        proc = NonInteractiveProcess([self.svn_path, 'status', '--xml',
+            '--depth', 'infinity'] + (names or []), cwd=self.root_dir,
+            merge_errors=False)
+        return proc.stream(self.parse_xml_statuses)
+
+    def parse_xml_statuses(self, lines):
+        """
+        Parses the output of svn status --xml as it is read, dropping every
+        entry once it has been parsed so that the memory used does not grow
+        with the size of the working copy. Externals are listed as targets
+        of their own.
+        """
+        statuses = {}
+        target = None
+        try:
+            for event, element in ElementTree.iterparse(RecordReader(lines,
+                    '\n'), events=('start', 'end')):
+                if event == 'start':
+                    if element.tag == 'target':
+                        target = element
+                    continue
+                if element.tag == 'entry':
+                    status = self.get_xml_status(element.find('wc-status'))
+                    if status:
+                        self.add_status(statuses, element.get('path'), status)
+                    if target != None:
+                        target.clear()
+                    else:
+                        element.clear()
+        except (SyntaxError, ExpatError) as (exception):
+            raise ProcessError('Unable to parse the output of svn status: ' +
+                str(exception))
+        return statuses
+
+    def get_xml_status(self, wc_status):
+        if wc_status == None:
+            return None
+        if wc_status.get('tree-conflicted') == 'true':
+            return 'C'
+        status = self.xml_statuses.get(wc_status.get('item'))
+        if status != None:
+            return status
+        # The file itself is unchanged, but its properties may not be
+        props = wc_status.get('props')
+        if props == 'conflicted':
+            return 'C'
+        if props == 'modified':
+            return 'M'
+        return None
+
+    def parse_statuses(self, lines):
+        statuses = {}
+        for line in lines:
+            if self.is_status_line(line):
+                self.add_status(statuses, line[8:], line[0])
+        return statuses
+
+    def is_status_line(self, line):
+        # Skip tree conflict details, changelist headers and externals
+        return len(line) >= 9 and line[6] != '>' and \
+            not line.startswith('---') and \
+            not line.startswith('Performing status')
+
+    def query_status(self, path):
+        matcher = self.get_path_matcher(path, 8)
+        proc = NonInteractiveProcess([self.svn_path, 'status',
+            os.path.relpath(path, self.root_dir)], cwd=self.root_dir)
+        line = proc.find(lambda line: self.is_status_line(line) and
+            matcher(line))
+        return line[0] if line != None else ''
+
+    def get_metadata_paths(self):
+        # Working copies older than 1.7 have no wc.db, use the fixed TTL
+        paths = VCS.get_metadata_paths(self)
+        if not os.path.exists(paths[0]):
+            return []
+        return paths
+
+    def get_base_id(self, path):
+        if sqlite3 == None:
+            return None
+        relpath = os.path.relpath(path, self.root_dir).replace(os.sep, '/')
+        try:
+            node = self.get_db().get_base_node(relpath)
+        except (UnsupportedFormatError, sqlite3.Error):
+            return None
+        if node == None or node['checksum'] == None or \
+                not node['checksum'].startswith('$sha1$'):
+            return None
+        return node['checksum']
+
+    def get_base_revision(self, path):
+        # The same content has different blame in different revisions
+        relpath = os.path.relpath(path, self.root_dir).replace(os.sep, '/')
+        try:
+            node = self.get_db().get_base_node(relpath)
+        except (UnsupportedFormatError, sqlite3.Error):
+            return None
+        return node['revision'] if node != None else None
+
+    def read_blame(self, path):
+        if ElementTree == None:
+            proc = NonInteractiveProcess([self.svn_path, 'blame',
+                os.path.relpath(path, self.root_dir)], cwd=self.root_dir,
+                merge_errors=False)
+            return proc.stream(self.parse_blame)
+
+        proc = NonInteractiveProcess([self.svn_path, 'blame', '--xml',
+            os.path.relpath(path, self.root_dir)], cwd=self.root_dir,
+            merge_errors=False)
+        return proc.stream(self.parse_xml_blame)
+
+    def parse_blame(self, lines):
+        blame = []
+        for line in lines:
+            parts = line.split(None, 2)
+            if len(parts) < 2:
+                parts = ['-', '-']
+            blame.append((parts[0], parts[1]))
+        return blame
+
+    def parse_xml_blame(self, lines):
+        blame = []
+        try:
+            for event, element in ElementTree.iterparse(RecordReader(lines,
+                    '\n')):
+                if element.tag != 'entry':
+                    continue
+                commit = element.find('commit')
+                if commit != None:
+                    blame.append(('r' + commit.get('revision'),
+                        commit.findtext('author', '')))
+                else:
+                    blame.append(('-', ''))
+                element.clear()
+        except (SyntaxError, ExpatError):
+            return None
+        return blame
+
+    def read_base(self, path, base_id):
+        sha = base_id[6:]
+        pristine_path = os.path.join(self.root_dir, '.svn', 'pristine',
+            sha[:2], sha + '.svn-base')
+        try:
+            with open(pristine_path, 'rb') as f:
+                return f.read()
+        except (IOError):
+            return None
+
+    def get_db(self):
+        if self.db == None:
+            db_path = os.path.join(self.root_dir, '.svn', 'wc.db')
+            if sqlite3 == None or not os.path.exists(db_path):
+                raise UnsupportedFormatError('Unable to open ' + db_path)
+            self.db = SVNWorkingCopyDb(db_path)
+        return self.db
+
+    def read_status(self, path):
+        """
+        Determines the status of a node from wc.db and the stat data of the
+        file without running svn. Returns None when svn has to decide, e.g.
+        for unversioned files that may be ignored, or for files whose
+        content has to be compared with the pristine copy.
+        """
+        if sqlite3 == None:
+            return None
+        relpath = os.path.relpath(path, self.root_dir).replace(os.sep, '/')
+        if relpath == '.':
+            relpath = ''
+        try:
+            db = self.get_db()
+            nodes = db.get_nodes(relpath)
+            if not nodes:
+                return None
+            if db.is_conflicted(relpath):
+                return 'C'
+        except (UnsupportedFormatError, sqlite3.Error):
+            return None
+
+        node = nodes[0]
+        has_base = nodes[-1]['op_depth'] == 0 and \
+            nodes[-1]['presence'] == 'normal'
+        if node['op_depth'] > 0:
+            if node['presence'] == 'base-deleted':
+                return 'D'
+            if node['presence'] != 'normal':
+                return None
+            # Only the root of a copy is shown as added, while every node of
+            # a scheduled addition is
+            depth = len(relpath.split('/')) if relpath else 0
+            if node['repos_id'] == None or node['op_depth'] == depth:
+                return 'R' if has_base else 'A'
+        elif node['presence'] == 'incomplete':
+            return '!'
+        elif node['presence'] != 'normal':
+            return None
+
+        if node['kind'] != 'file':
+            return '' if os.path.isdir(path) else '!'
+        try:
+            stat = os.stat(path)
+        except (OSError):
+            return '!'
+        if node['translated_size'] == None or node['last_mod_time'] == None:
+            return None
+        if stat.st_size != node['translated_size']:
+            return 'M'
+        # Subversion records modification times in microseconds
+        if int(round(stat.st_mtime * 1000000)) != node['last_mod_time']:
+            return None
+        return ''
+
+    def is_tracked_dir(self, path):
+        if sqlite3 == None:
+            return None
+        relpath = self.get_names_prefix(path).rstrip('/')
+        try:
+            nodes = self.get_db().get_nodes(relpath)
+        except (UnsupportedFormatError, sqlite3.Error):
+            return None
+        return len(nodes) > 0 and nodes[0]['presence'] in ['normal',
+            'incomplete']
+
+    def check_status(self, path, fingerprint=None, cache_length=0):
         if os.path.isdir(path):
-            proc = NonInteractiveProcess([self.git_path, 'log', '-1', path],
-                cwd=self.root_dir)
-            result = proc.run().strip().split('\n')
-            if result == ['']:
-                return '?'
-            return ''
+            return self.check_dir_status(path, fingerprint, cache_length)
 
-        proc = NonInteractiveProcess([self.git_path, 'status', '--short'],
-            cwd=self.root_dir)
-        result = proc.run().strip().split('\n')
-        for line in result:
-            if len(line) < 2:
-                continue
-            path_without_root = path.replace(self.root_dir + '\\', '', 1)
-            path_regex = re.escape(path_without_root) + '$'
-            if self.root_dir != path and re.search(path_regex, line) == None:
+        snapshot = self.get_fresh_snapshot(path, fingerprint, cache_length)
+        if snapshot != None:
+            return snapshot.get(path)
+
+        status = self.read_status(path)
+        if status != None:
+            return status
+
+        return self.get_file_status(path, fingerprint, cache_length)
+
+
+class GitIndexEntry(object):
+    __slots__ = ['mtime', 'size', 'mode', 'sha', 'stage', 'intent_to_add',
+        'skip_worktree']
+
+
+class GitIndex():
+    """
+    A reader for versions 2 to 4 of the .git/index file. The entry table is
+    only parsed the first time an entry is looked up, and entries are only
+    decoded when requested.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.signature = stat_signature(path)
+        self.offsets = None
+        self.names = None
+        self.conflicts = set()
+
+        with open(path, 'rb') as f:
+            # Git for Windows cannot replace an index that is memory-mapped
+            if os.name == 'nt':
+                self.data = f.read()
+            else:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[0:4] != 'DIRC':
+            raise UnsupportedFormatError('Invalid git index signature')
+        self.version, self.count = struct.unpack('>II', self.data[4:12])
+        if self.version not in [2, 3, 4]:
+            raise UnsupportedFormatError('Unsupported git index version %d' %
+                self.version)
+
+    def parse(self):
+        data = self.data
+        offsets = {}
+        # Entries are sorted by name, so the list can be bisected
+        names = []
+        offset = 12
+        name = ''
+        for i in xrange(self.count):
+            flags, = struct.unpack('>H', data[offset + 60:offset + 62])
+            name_offset = offset + 62
+            if flags & 0x4000 and self.version >= 3:
+                name_offset += 2
+
+            if self.version == 4:
+                # The name drops a number of trailing bytes from the previous
+                # name and appends a NUL-terminated suffix, without padding
+                pos = name_offset
+                byte = ord(data[pos])
+                strip = byte & 0x7f
+                while byte & 0x80:
+                    pos += 1
+                    byte = ord(data[pos])
+                    strip = ((strip + 1) << 7) | (byte & 0x7f)
+                end = data.find('\0', pos + 1)
+                name = name[:len(name) - strip] + data[pos + 1:end]
+                next_offset = end + 1
+            else:
+                end = data.find('\0', name_offset)
+                name = data[name_offset:end]
+                next_offset = offset + ((name_offset - offset + len(name) +
+                    8) & ~7)
+
+            if (flags >> 12) & 3:
+                self.conflicts.add(name)
+            if name not in offsets:
+                offsets[name] = offset
+                names.append(name)
+            offset = next_offset
+
+        # Split and sparse indexes keep entries outside of this file
+        while offset + 8 <= len(data) - 20:
+            signature = data[offset:offset + 4]
+            size, = struct.unpack('>I', data[offset + 4:offset + 8])
+            if signature in ['link', 'sdir']:
+                raise UnsupportedFormatError('Unsupported git index ' +
+                    'extension ' + signature)
+            offset += 8 + size
+
+        self.offsets = offsets
+        self.names = names
+
+    def has_prefix(self, prefix):
+        """
+        Returns if any entry name starts with prefix
+        """
+        if self.names == None:
+            self.parse()
+        i = bisect.bisect_left(self.names, prefix)
+        return i < len(self.names) and self.names[i].startswith(prefix)
+
+    def get(self, name):
+        """
+        Returns the GitIndexEntry for the slash-separated path name relative
+        to the root of the working copy, or None
+        """
+        if self.offsets == None:
+            self.parse()
+        offset = self.offsets.get(name)
+        if offset == None:
+            return None
+
+        data = self.data
+        fields = struct.unpack('>IIII', data[offset + 8:offset + 24])
+        entry = GitIndexEntry()
+        entry.mtime = fields[0]
+        entry.mode, = struct.unpack('>I', data[offset + 24:offset + 28])
+        entry.size, = struct.unpack('>I', data[offset + 36:offset + 40])
+        entry.sha = data[offset + 40:offset + 60].encode('hex')
+        flags, = struct.unpack('>H', data[offset + 60:offset + 62])
+        entry.stage = 1 if name in self.conflicts else 0
+        extended = 0
+        if flags & 0x4000 and self.version >= 3:
+            extended, = struct.unpack('>H', data[offset + 62:offset + 64])
+        entry.intent_to_add = bool(extended & 0x2000)
+        entry.skip_worktree = bool(extended & 0x4000)
+        return entry
+
+    def is_racy(self, entry):
+        """
+        Entries written in the same second as the index can not be trusted to
+        be unmodified based on their stat data alone
+        """
+        return entry.mtime >= int(self.signature[0])
+
+
+class GitCheckIgnore(PersistentProcess):
+    """
+    A git check-ignore --stdin process that tells which of the paths written
+    to it are ignored
+    """
+    # Paths are sent in batches small enough for the answers to fit in the
+    # pipe, so that git never blocks writing while it is sent more paths
+    batch_size = 100
+
+    def __init__(self, git_path, root_dir, idle_timeout):
+        env = dict(os.environ)
+        env['GIT_FLUSH'] = '1'
+        PersistentProcess.__init__(self, [git_path, 'check-ignore', '--stdin',
+            '-z', '-v', '--non-matching'], root_dir, idle_timeout, env)
+
+    def communicate(self, names):
+        ignored = []
+        for i in range(0, len(names), self.batch_size):
+            batch = names[i:i + self.batch_size]
+            self.proc.stdin.write(''.join([name + '\0' for name in batch]))
+            self.proc.stdin.flush()
+            for name in batch:
+                source = self.read_until('\0')
+                line = self.read_until('\0')
+                pattern = self.read_until('\0')
+                self.read_until('\0')
+                # Negated patterns match paths that are not ignored
+                ignored.append(pattern != '' and not pattern.startswith('!'))
+        return ignored
+
+    def run(self, names):
+        """
+        Returns whether each of names, relative to the working copy root, is
+        ignored
+        """
+        return self.request(names)
+
+
+class GitCatFile(PersistentProcess):
+    """
+    A git cat-file --batch process that reads objects by name, e.g. a blob
+    sha or HEAD:path
+    """
+    def __init__(self, git_path, root_dir, idle_timeout):
+        PersistentProcess.__init__(self, [git_path, 'cat-file', '--batch'],
+            root_dir, idle_timeout)
+
+    def communicate(self, name):
+        self.proc.stdin.write(name + '\n')
+        self.proc.stdin.flush()
+        header = self.read_until('\n').split(' ')
+        if len(header) != 3:
+            return None
+        sha, type, size = header
+        data = self.read_exactly(int(size))
+        self.read_exactly(1)
+        return (sha, type, data)
+
+    def run(self, name):
+        """
+        Returns a tuple of the sha, type and content of an object, or None
+        if there is no such object
+        """
+        return self.request(name)
+
+
+class Git(VCS):
+    def __init__(self, git_path, root_dir):
+        config = get_config()
+        self.git_path = git_path
+        self.root_dir = root_dir
+        self.git_dir = os.path.join(root_dir, '.git')
+
+        # Linked worktrees and submodules use a .git file pointing elsewhere
+        if os.path.isfile(self.git_dir):
+            with open(self.git_dir) as f:
+                contents = f.read().strip()
+            if contents.startswith('gitdir:'):
+                self.git_dir = os.path.normpath(os.path.join(root_dir,
+                    contents[7:].strip()))
+
+        # Linked worktrees share the objects, refs and config of the main one
+        self.common_dir = self.git_dir
+        commondir_path = os.path.join(self.git_dir, 'commondir')
+        if os.path.exists(commondir_path):
+            with open(commondir_path) as f:
+                self.common_dir = os.path.normpath(os.path.join(self.git_dir,
+                    f.read().strip()))
+        self.object_format = self.read_object_format()
+
+        self.index = None
+        self.trees = {}
+        self.check_ignore = None
+        self.cat_file = None
+        if config.git_helper_processes:
+            helper_timeout = config.git_helper_timeout
+            self.check_ignore = GitCheckIgnore(self.git_path, root_dir,
+                helper_timeout)
+            self.cat_file = GitCatFile(self.git_path, root_dir,
+                helper_timeout)
+
+    def stop(self):
+        for helper in [self.check_ignore, self.cat_file]:
+            if helper != None:
+                helper.stop_if_unused()
+
+    def get_metadata_paths(self):
+        return [os.path.join(self.git_dir, 'index'),
+            os.path.join(self.git_dir, 'HEAD')]
+
+    def get_fingerprint(self):
+        # Commits and resets move the branch HEAD points to without touching
+        # HEAD, and git reset --soft leaves the index alone as well
+        return VCS.get_fingerprint(self) + (self.get_revision(),)
+
+    def read_object_format(self):
+        """
+        Returns the hash algorithm of the repository, sha1 unless the config
+        sets extensions.objectFormat
+        """
+        section = None
+        try:
+            with open(os.path.join(self.common_dir, 'config')) as f:
+                for line in f:
+                    line = line.split('#', 1)[0].split(';', 1)[0].strip()
+                    if line.startswith('['):
+                        section = line.strip('[]').strip().lower()
+                    elif section == 'extensions' and '=' in line:
+                        name, value = line.split('=', 1)
+                        if name.strip().lower() == 'objectformat':
+                            return value.strip().strip('"').lower()
+        except (IOError):
+            pass
+        return 'sha1'
+
+    def get_revision(self):
+        try:
+            return self.read_head()
+        except (EnvironmentError):
+            return None
+
+    def read_head(self):
+        """
+        Returns the hex id of the commit HEAD points to, or None for a branch
+        without commits
+        """
+        with open(os.path.join(self.git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+        if not head.startswith('ref:'):
+            return head
+        ref = head[4:].strip()
+
+        for dir in [self.git_dir, self.common_dir]:
+            ref_path = os.path.join(dir, *ref.split('/'))
+            if os.path.exists(ref_path):
+                with open(ref_path) as f:
+                    return f.read().strip()
+
+        packed_refs_path = os.path.join(self.common_dir, 'packed-refs')
+        if os.path.exists(packed_refs_path):
+            with open(packed_refs_path) as f:
+                for line in f:
+                    parts = line.strip().split(' ')
+                    if len(parts) == 2 and parts[1] == ref:
+                        return parts[0]
+        return None
+
+    def get_head_entry(self, name):
+        """
+        Returns a tuple of the mode and hex id HEAD has for the
+        slash-separated path name, or None if HEAD does not contain it.
+        Raises UnsupportedFormatError without a git cat-file process.
+        """
+        commit = self.read_head()
+        if commit == None:
+            return None
+        data = self.read_object(commit, 'commit')
+        if data == None or not data.startswith('tree '):
+            raise UnsupportedFormatError('Unable to read HEAD commit')
+
+        entry = ('40000', data[5:data.index('\n')])
+        for part in name.split('/'):
+            if not entry[0].startswith('4'):
+                return None
+            entry = self.read_tree(entry[1]).get(part)
+            if entry == None:
+                return None
+        return entry
+
+    def read_tree(self, id):
+        tree = self.trees.get(id)
+        if tree == None:
+            data = self.read_object(id, 'tree')
+            if data == None:
+                raise UnsupportedFormatError('Unable to read tree ' + id)
+            # Entries are the mode and name, then the binary object id
+            id_size = 32 if self.object_format == 'sha256' else 20
+            tree = {}
+            pos = 0
+            while pos < len(data):
+                space = data.find(' ', pos)
+                nul = data.find('\0', space)
+                tree[data[space + 1:nul]] = (data[pos:space],
+                    data[nul + 1:nul + 1 + id_size].encode('hex'))
+                pos = nul + 1 + id_size
+            if len(self.trees) > 1000:
+                self.trees.clear()
+            self.trees[id] = tree
+        return tree
+
+    def read_object(self, name, type):
+        """
+        Returns the content of an object of the given type through the git
+        cat-file process, or None if there is no such object
+        """
+        if self.cat_file == None:
+            raise UnsupportedFormatError('git helper processes are disabled')
+        result = self.cat_file.run(name)
+        if result == None or result[1] != type:
+            return None
+        return result[2]
+
+    def get_size(self):
+        try:
+            return self.get_index().count
+        except (UnsupportedFormatError, IOError, OSError, struct.error):
+            return None
+
+    def read_statuses(self, names=None):
+        args = [self.git_path, 'status', '--porcelain', '-z']
+        if names:
+            args += ['--'] + names
+        proc = NonInteractiveProcess(args, cwd=self.root_dir)
+        return proc.stream(self.parse_statuses, '\0')
+
+    def parse_statuses(self, records):
+        statuses = {}
+        records = iter(records)
+        for record in records:
+            if len(record) < 4:
                 continue
+            # Renames and copies are followed by a record with the old path
+            if record[0] in 'RC':
+                next(records, None)
+            self.add_status(statuses, record[3:],
+                self.get_record_status(record))
+        return statuses
+
+    def get_record_status(self, record):
+        res = record[0] if record[0] != ' ' else record[1]
+        return res.upper()
+
+    def query_status(self, path):
+        proc = NonInteractiveProcess([self.git_path, 'status', '--porcelain',
+            '-z', '--', os.path.relpath(path, self.root_dir)],
+            cwd=self.root_dir)
+        record = proc.find(self.get_path_matcher(path, 3), '\0')
+        return self.get_record_status(record) if record != None else ''
+
+    def check_scoped_status(self, status):
+        # A pathspec hides the old path of a staged rename, so a renamed file
+        # is only reported as R when the whole working copy is listed
+        return None if status == 'A' else status
+
+    def is_ignored(self, path):
+        """
+        Returns if git ignores path, or None if that can not be determined
+        without running git status
+        """
+        if self.check_ignore == None:
+            return None
+        name = os.path.relpath(path, self.root_dir).replace(os.sep, '/')
+        try:
+            return self.check_ignore.run([name])[0]
+        except (IOError, OSError):
+            return None
 
-            if line[0] != ' ':
-                res = line[0]
+    def get_base_id(self, path):
+        name = os.path.relpath(path, self.root_dir).replace(os.sep, '/')
+        try:
+            if self.cat_file != None:
+                entry = self.get_head_entry(name)
             else:
-                res = line[1]
-            return res.upper()
-        return ''
+                entry = self.list_head_entry(name)
+        except (UnsupportedFormatError, ProcessError, IOError, OSError,
+                ValueError):
+            return None
+        # Only regular files have content to diff
+        if entry == None or not entry[0].startswith('100'):
+            return None
+        return entry[1]
+
+    def list_head_entry(self, name):
+        proc = NonInteractiveProcess([self.git_path, 'ls-tree', 'HEAD', '--',
+            name], cwd=self.root_dir, merge_errors=False)
+        record = proc.find(lambda record: record.endswith('\t' + name))
+        if record == None:
+            return None
+        mode, type, id = record.split('\t', 1)[0].split(' ')
+        return (mode, id)
+
+    def read_base(self, path, base_id):
+        if self.cat_file != None:
+            try:
+                return self.read_object(base_id, 'blob')
+            except (IOError, OSError, ValueError):
+                return None
+        proc = NonInteractiveProcess([self.git_path, 'cat-file', 'blob',
+            base_id], cwd=self.root_dir, merge_errors=False)
+        # Text files contain no NULs, so joining the records restores them
+        return proc.stream(self.join_records, '\0')
+
+    def join_records(self, records):
+        return '\0'.join(records)
+
+    def read_blame(self, path):
+        proc = NonInteractiveProcess([self.git_path, 'blame', '--porcelain',
+            'HEAD', '--', os.path.relpath(path, self.root_dir)],
+            cwd=self.root_dir, merge_errors=False)
+        return proc.stream(self.parse_blame)
+
+    def parse_blame(self, lines):
+        blame = []
+        authors = {}
+        sha = None
+        # Headers start with the commit id, which is longer in sha256
+        # repositories
+        id_length = 64 if self.object_format == 'sha256' else 40
+        for line in lines:
+            if line.startswith('\t'):
+                blame.append((sha[:8], authors.get(sha, '')))
+            elif line.startswith('author '):
+                authors[sha] = line[7:]
+            elif len(line) > id_length and line[id_length] == ' ' and \
+                    not line[:id_length].strip('0123456789abcdef'):
+                sha = line[:id_length]
+        return blame
+
+    def get_index(self):
+        # Index entries hold 20 byte object ids only in sha1 repositories
+        if self.object_format != 'sha1':
+            raise UnsupportedFormatError('Unsupported git object format ' +
+                self.object_format)
+        index_path = os.path.join(self.git_dir, 'index')
+        if self.index == None or \
+                self.index.signature != stat_signature(index_path):
+            self.index = GitIndex(index_path)
+        return self.index
+
+    def is_tracked_dir(self, path):
+        try:
+            if not os.path.exists(os.path.join(self.git_dir, 'index')):
+                return False
+            return self.get_index().has_prefix(self.get_names_prefix(path))
+        except (UnsupportedFormatError, IOError, OSError, struct.error):
+            return None
+
+    def read_status(self, path):
+        """
+        Determines the status of a file from the index, HEAD and the stat
+        data of the file without running git status. Returns None when git
+        has to decide, e.g. for staged additions that may be renames, or files
+        whose content has to be compared.
+        """
+        name = os.path.relpath(path, self.root_dir).replace(os.sep, '/')
+        try:
+            if not os.path.exists(os.path.join(self.git_dir, 'index')):
+                return None
+            entry = self.get_index().get(name)
+            if entry != None and entry.stage:
+                return 'U'
+            head_entry = self.get_head_entry(name)
+        except (UnsupportedFormatError, IOError, OSError, ValueError,
+                struct.error):
+            return None
+
+        if entry == None:
+            if head_entry != None:
+                return 'D'
+            if not os.path.isfile(path):
+                return None
+            # git status does not list ignored files either
+            ignored = self.is_ignored(path)
+            if ignored == None:
+                return None
+            return '' if ignored else '?'
+        # Submodules have their own working copy
+        if entry.mode == 0160000:
+            return None
+
+        # The staged status takes precedence over the working tree one
+        if entry.intent_to_add:
+            return 'A'
+        # New files may be reported as renames of files deleted from HEAD
+        if head_entry == None:
+            return None
+        if head_entry[1] != entry.sha or int(head_entry[0], 8) != entry.mode:
+            return 'M'
+        if entry.skip_worktree:
+            return ''
 
+        try:
+            stat = os.stat(path)
+        except (OSError):
+            return 'D'
+        if stat.st_size & 0xffffffff != entry.size:
+            return 'M'
+        if int(stat.st_mtime) != entry.mtime or self.index.is_racy(entry):
+            return None
+        return ''
 
-class Hg():
-    def __init__(self, tortoise_proc_path, root_dir):
-        self.hg_path = os.path.dirname(tortoise_proc_path) + '\\hg.exe'
+    def check_status(self, path, fingerprint=None, cache_length=0):
+        if os.path.isdir(path):
+            return self.check_dir_status(path, fingerprint, cache_length)
+
+        snapshot = self.get_fresh_snapshot(path, fingerprint, cache_length)
+        if snapshot != None:
+            return snapshot.get(path)
+
+        status = self.read_status(path)
+        if status != None:
+            return status
+
+        return self.get_file_status(path, fingerprint, cache_length)
+
+
+class HgCommandServer(PersistentProcess):
+    """
+    A Mercurial command server, as started by hg serve --cmdserver pipe,
+    that runs hg commands without starting a new interpreter for each one
+    """
+    def __init__(self, hg_path, root_dir, idle_timeout):
+        env = dict(os.environ)
+        env['HGPLAIN'] = '1'
+        PersistentProcess.__init__(self, [hg_path, 'serve', '--cmdserver',
+            'pipe', '--config', 'ui.interactive=False'], root_dir,
+            idle_timeout, env)
+
+    def handshake(self):
+        channel, data = self.read_message()
+        if channel != 'o' or 'runcommand' not in data:
+            raise IOError('Unexpected hello message from hg command server')
+
+    def read_message(self):
+        channel = self.read_exactly(1)
+        length, = struct.unpack('>I', self.read_exactly(4))
+        if channel in 'IL':
+            raise ProcessError('The hg command server requested input')
+        return (channel, self.read_exactly(length))
+
+    def communicate(self, args):
+        data = '\0'.join(args)
+        self.proc.stdin.write('runcommand\n' + struct.pack('>I', len(data)) +
+            data)
+        self.proc.stdin.flush()
+
+        output = []
+        errors = []
+        while True:
+            channel, data = self.read_message()
+            if channel == 'o':
+                output.append(data)
+            elif channel == 'e':
+                errors.append(data)
+            elif channel == 'r':
+                returncode, = struct.unpack('>i', data)
+                return (returncode, ''.join(output).replace('\r\n', '\n'),
+                    ''.join(errors).strip())
+
+    def run(self, args):
+        """
+        Returns the output of an hg command, raising ProcessError if it fails
+        """
+        returncode, output, errors = self.request(args)
+        if returncode != 0:
+            raise ProcessError('hg %s failed: %s' % (args[0], errors or
+                'exit status %d' % returncode), returncode)
+        return output
+
+
+class HgDirstate():
+    """
+    A reader for the names of the files tracked in a version 1 .hg/dirstate
+    """
+    def __init__(self, path):
+        self.signature = stat_signature(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        names = []
+        # The two parent node ids are followed by the file entries
+        offset = 40
+        while offset + 17 <= len(data):
+            length, = struct.unpack('>i', data[offset + 13:offset + 17])
+            name = data[offset + 17:offset + 17 + length]
+            # Copied files have their source appended after a NUL
+            names.append(name.split('\0', 1)[0])
+            offset += 17 + length
+        names.sort()
+        self.names = names
+
+    def has_prefix(self, prefix):
+        i = bisect.bisect_left(self.names, prefix)
+        return i < len(self.names) and self.names[i].startswith(prefix)
+
+
+class Hg(VCS):
+    metadata_files = [os.path.join('.hg', 'dirstate')]
+
+    def __init__(self, hg_path, root_dir):
+        config = get_config()
+        self.hg_path = hg_path
         self.root_dir = root_dir
+        self.server = None
+        self.server_failures = 0
+        self.dirstate = None
+        if config.hg_command_server:
+            self.server = HgCommandServer(self.hg_path, root_dir,
+                config.hg_command_server_timeout)
+
+    def stop(self):
+        if self.server != None:
+            self.server.stop_if_unused()
+
+    def run_hg(self, args):
+        return process_scheduler.run(self.root_dir,
+            tuple([self.hg_path] + args), lambda: self.execute_hg(args))
+
+    def execute_hg(self, args):
+        if self.server != None:
+            try:
+                output = self.server.run(args)
+                self.server_failures = 0
+                return output
+            except (IOError, OSError, struct.error):
+                # Give up on versions of hg without a working command server
+                self.server_failures += 1
+                if self.server_failures >= 3:
+                    self.server = None
+        # Errors are not part of the output of the command server either
+        proc = NonInteractiveProcess([self.hg_path] + args,
+            cwd=self.root_dir, merge_errors=False)
+        return proc.execute()
+
+    def read_statuses(self, names=None):
+        statuses = {}
+        for line in self.run_hg(['status'] + (names or [])).split('\n'):
+            if len(line) < 3:
+                continue
+            self.add_status(statuses, line[2:], line[0].upper())
+        return statuses
 
-    def check_status(self, path):
+    def is_tracked_dir(self, path):
+        dirstate_path = os.path.join(self.root_dir, '.hg', 'dirstate')
+        try:
+            with open(os.path.join(self.root_dir, '.hg', 'requires')) as f:
+                if 'dirstate-v2' in f.read().split():
+                    return None
+            if not os.path.exists(dirstate_path):
+                return False
+            if self.dirstate == None or \
+                    self.dirstate.signature != stat_signature(dirstate_path):
+                self.dirstate = HgDirstate(dirstate_path)
+        except (IOError, OSError, struct.error):
+            return None
+        return self.dirstate.has_prefix(self.get_names_prefix(path))
+
+    def get_base_id(self, path):
+        # The first dirstate parent is the revision the working copy is at
+        try:
+            with open(os.path.join(self.root_dir, '.hg', 'dirstate'),
+                    'rb') as f:
+                parent = f.read(20)
+        except (IOError):
+            return None
+        if len(parent) < 20:
+            return None
+        return parent.encode('hex') + ':' + os.path.relpath(path,
+            self.root_dir).replace(os.sep, '/')
+
+    def read_base(self, path, base_id):
+        try:
+            return self.run_hg(['cat', '-r', '.', os.path.relpath(path,
+                self.root_dir)])
+        except (ProcessError) as (exception):
+            # hg cat exits with 1 when the file is not in the revision, e.g.
+            # because it was added since
+            if exception.returncode == 1:
+                return None
+            raise
+
+    def read_blame(self, path):
+        output = self.run_hg(['annotate', '-r', '.', '-u', '-n',
+            os.path.relpath(path, self.root_dir)])
+        blame = []
+        for line in output.split('\n'):
+            if ':' not in line:
+                continue
+            parts = line.split(':', 1)[0].strip().rsplit(None, 1)
+            if len(parts) == 2:
+                blame.append(('r' + parts[1], parts[0]))
+        return blame
+
+    def get_size(self):
+        # The dirstate is only parsed when it is needed anyway
+        if self.dirstate == None:
+            return None
+        return len(self.dirstate.names)
+
+    def query_status(self, path):
+        matcher = self.get_path_matcher(path, 2)
+        output = self.run_hg(['status', os.path.relpath(path, self.root_dir)])
+        for line in output.split('\n'):
+            if matcher(line):
+                return line[0].upper()
+        return ''
+
+    def check_status(self, path, fingerprint=None, cache_length=0):
         if os.path.isdir(path):
-            proc = NonInteractiveProcess([self.hg_path, 'log', '-l', '1',
-                '"' + path + '"'], cwd=self.root_dir)
-            result = proc.run().strip().split('\n')
-            if result == ['']:
-                return '?'
-            return ''
+            return self.check_dir_status(path, fingerprint, cache_length)
 
-        proc = NonInteractiveProcess([self.hg_path, 'status', path],
-            cwd=self.root_dir)
-        result = proc.run().split('\n')
-        for line in result:
-            if len(line) < 1:
-                continue
-            return line[0].upper()
-        return ''
\ No newline at end of file
+        return self.get_file_status(path, fingerprint, cache_length)
+
+
+# Sublime Text 2 has no plugin_loaded() callback, but allows using the API
+# as soon as the plugin is imported
+if int(sublime.version()) < 3000:
+    sublime.set_timeout(plugin_loaded, 0)
\ No newline at end of file
@@ -0,0 +1,382 @@
+"""
+Benchmarks root discovery, status lookups and the menu predicates of
+Tortoise.py against synthetic Git, Mercurial and SVN working copies, cold and
+warm, and writes the timings as JSON so that runs can be compared.
+
+It runs headless with the same Python 2 as Sublime Text, using the stub
+sublime modules next to it. VCSs whose command line clients are not
+installed are skipped. Generated working copies are kept in the work
+directory and reused by later runs with the same parameters.
+
+    python bench/benchmark.py --vcs git,hg --sizes 1000,10000 \\
+        --output results.json
+"""
+import sys
+import os
+import json
+import optparse
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from distutils.spawn import find_executable
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, bench_dir)
+sys.path.insert(1, os.path.dirname(bench_dir))
+
+import sublime
+import Tortoise
+
+
+markers = {'git': '.git', 'hg': '.hg', 'svn': '.svn'}
+binaries = {'git': 'git', 'hg': 'hg', 'svn': 'svn'}
+
+
+def run(args, cwd):
+    devnull = open(os.devnull, 'w')
+    try:
+        subprocess.check_call(args, cwd=cwd, stdout=devnull, stderr=devnull)
+    finally:
+        devnull.close()
+
+
+class RepoBuilder():
+    """
+    Generates a working copy with count committed files spread over
+    directories depth levels deep, then modifies and adds files
+    """
+    files_per_dir = 20
+    dirs_per_dir = 10
+
+    def __init__(self, vcs, count, modified, untracked, depth, work_dir):
+        self.vcs = vcs
+        self.count = count
+        self.modified = modified
+        self.untracked = untracked
+        self.depth = depth
+        name = '%s-%d-%g-%g-%d' % (vcs, count, modified, untracked, depth)
+        self.base_dir = os.path.join(work_dir, name)
+        self.root_dir = os.path.join(self.base_dir, 'wc')
+        self.binary = find_executable(binaries[vcs])
+
+    def get_path(self, i, prefix='f'):
+        dir_index = i // self.files_per_dir
+        parts = []
+        for level in range(self.depth):
+            parts.append('d%d' % (dir_index % self.dirs_per_dir))
+            dir_index //= self.dirs_per_dir
+        return os.path.join(self.root_dir, *(parts + ['%s%d.txt' %
+            (prefix, i)]))
+
+    def write(self, path, content):
+        dir = os.path.dirname(path)
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        with open(path, 'a') as f:
+            f.write(content)
+
+    def build(self, rebuild=False):
+        done_path = self.base_dir + '.done'
+        if os.path.exists(done_path) and not rebuild:
+            return
+        if os.path.exists(self.base_dir):
+            shutil.rmtree(self.base_dir)
+        if os.path.exists(done_path):
+            os.remove(done_path)
+        os.makedirs(self.base_dir)
+
+        getattr(self, 'init_' + self.vcs)()
+        for i in range(self.count):
+            self.write(self.get_path(i), 'line 1 of file %d\n' % i)
+        getattr(self, 'commit_' + self.vcs)()
+
+        generator = random.Random(self.count)
+        for i in generator.sample(xrange(self.count),
+                int(self.count * self.modified)):
+            self.write(self.get_path(i), 'modified\n')
+        for i in range(int(self.count * self.untracked)):
+            self.write(self.get_path(generator.randrange(self.count), 'u'),
+                'untracked\n')
+        open(done_path, 'w').close()
+
+    def init_git(self):
+        os.makedirs(self.root_dir)
+        run([self.binary, 'init', '-q'], self.root_dir)
+
+    def commit_git(self):
+        run([self.binary, 'add', '-A'], self.root_dir)
+        run([self.binary, '-c', 'user.name=bench', '-c',
+            'user.email=bench@example.com', 'commit', '-q', '-m', 'init'],
+            self.root_dir)
+
+    def init_hg(self):
+        os.makedirs(self.root_dir)
+        run([self.binary, 'init'], self.root_dir)
+
+    def commit_hg(self):
+        run([self.binary, 'add', '-q'], self.root_dir)
+        run([self.binary, 'commit', '-q', '-u', 'bench', '-m', 'init'],
+            self.root_dir)
+
+    def init_svn(self):
+        repo_dir = os.path.join(self.base_dir, 'repo')
+        run([find_executable('svnadmin'), 'create', repo_dir], self.base_dir)
+        run([self.binary, 'checkout', '-q', 'file://' + repo_dir.replace(
+            os.sep, '/'), self.root_dir], self.base_dir)
+
+    def commit_svn(self):
+        run([self.binary, 'add', '-q', '--force', '.'], self.root_dir)
+        run([self.binary, 'commit', '-q', '-m', 'init'], self.root_dir)
+
+
+class View():
+    def __init__(self, path):
+        self.path = path
+
+    def file_name(self):
+        return self.path
+
+
+class Window():
+    def __init__(self, path):
+        self.view = View(path)
+
+    def active_view(self):
+        return self.view
+
+
+class Benchmark():
+    def __init__(self, builder, repeat):
+        self.builder = builder
+        self.repeat = repeat
+        self.command = Tortoise.TortoiseCommand()
+        self.file_path = builder.get_path(0)
+        self.dir_path = os.path.dirname(self.file_path)
+        self.context_menu = self.load_menu('Context.sublime-menu')
+        self.side_bar_menu = self.load_menu('Side Bar.sublime-menu')
+
+    def load_menu(self, name):
+        with open(os.path.join(os.path.dirname(bench_dir), name)) as f:
+            return [item for item in json.load(f) if 'command' in item]
+
+    def load_settings(self):
+        # The default settings are JSON with comments on lines of their own
+        path = os.path.join(os.path.dirname(bench_dir),
+            'Tortoise.sublime-settings')
+        with open(path) as f:
+            lines = [line for line in f if not line.strip().startswith('//')]
+        return json.loads(''.join(lines))
+
+    def setup(self):
+        sublime.settings.clear()
+        sublime.settings.update(self.load_settings())
+        sublime.settings.update({
+            'git_tgit_path': find_executable('git'),
+            'git_tortoiseproc_path': 'TortoiseProc.exe',
+            'svn_tortoiseproc_path': 'TortoiseProc.exe',
+            'hg_hgtk_path': 'thgw.exe',
+            'persistent_cache': False,
+            'debug': False
+        })
+        # The stub settings do not notify on changes
+        Tortoise.load_config()
+
+        # SVN runs the svn.exe bundled with the package
+        if self.builder.vcs == 'svn':
+            svn_dir = os.path.join(sublime.packages_dir, 'Tortoise', 'svn')
+            if not os.path.exists(svn_dir):
+                os.makedirs(svn_dir)
+            svn_path = os.path.join(svn_dir, 'svn.exe')
+            if os.path.lexists(svn_path):
+                os.remove(svn_path)
+            os.symlink(self.builder.binary, svn_path)
+
+    def get_vcs(self, path):
+        vcs = self.command.get_vcs(path)
+        # Mercurial is run from the TortoiseHg directory on Windows
+        backend = vcs.get_backend()
+        if isinstance(backend, Tortoise.Hg) and \
+                backend.hg_path != self.builder.binary:
+            backend.hg_path = self.builder.binary
+            if backend.server != None:
+                backend.server = Tortoise.HgCommandServer(backend.hg_path,
+                    backend.root_dir, 300)
+        return vcs
+
+    def reset(self):
+        self.wait()
+        for vcs in Tortoise.vcs_instances.values():
+            backend = vcs.get_backend()
+            if isinstance(backend, Tortoise.Hg) and backend.server != None:
+                backend.server.stop()
+        Tortoise.vcs_instances.clear()
+        Tortoise.root_index = Tortoise.RootIndex()
+        Tortoise.status_cache.clear()
+
+    def wait(self):
+        service = Tortoise.status_service
+        while service.pending or not service.queue.empty():
+            time.sleep(0.001)
+
+    def time(self, fn):
+        start = time.time()
+        fn()
+        return time.time() - start
+
+    def measure(self, fn, setup=None):
+        """
+        Returns the timings of repeat calls of fn, in milliseconds
+        """
+        timings = []
+        for i in range(self.repeat):
+            if setup != None:
+                setup()
+            timings.append(self.time(fn) * 1000)
+        return timings
+
+    def summarize(self, timings):
+        timings = sorted(timings)
+        return {
+            'min': timings[0],
+            'median': timings[len(timings) // 2],
+            'mean': sum(timings) / len(timings),
+            'max': timings[-1],
+            'runs': len(timings)
+        }
+
+    def open_menu(self, menu, path, paths):
+        window = Window(path)
+        for item in menu:
+            name = ''.join([part.capitalize() for part in
+                item['command'].split('_')]) + 'Command'
+            command = getattr(Tortoise, name)(window)
+            args = dict(item.get('args', {}))
+            if args.get('paths') == []:
+                args['paths'] = paths
+            command.is_visible(**args)
+            if hasattr(command, 'is_enabled'):
+                command.is_enabled(**args)
+
+    def run(self):
+        self.setup()
+        results = {}
+        marker = markers[self.builder.vcs]
+
+        def find_root():
+            Tortoise.Tortoise().find_root(marker, self.file_path)
+        results['find_root'] = self.measure(find_root)
+
+        get_vcs = lambda: self.get_vcs(self.file_path)
+        results['get_vcs_cold'] = self.measure(get_vcs, self.reset)
+        results['get_vcs_warm'] = self.measure(get_vcs)
+
+        # Cold lookups return at once and queue the status command, the
+        # status is known once the status service is idle again
+        for name, path in [('file', self.file_path),
+                ('dir', self.builder.root_dir)]:
+            get_status = lambda: self.get_vcs(path).get_status(path)
+            results['get_status_%s_cold' % name] = self.measure(get_status,
+                self.reset)
+            results['get_status_%s_known' % name] = self.measure(
+                lambda: (get_status(), self.wait()), self.reset)
+            results['get_status_%s_warm' % name] = self.measure(get_status)
+
+        for name, menu, path, paths in [
+                ('context_menu', self.context_menu, self.file_path, True),
+                ('side_bar_menu', self.side_bar_menu, self.file_path,
+                    [self.dir_path])]:
+            open_menu = lambda: self.open_menu(menu, path, paths)
+            results[name + '_cold'] = self.measure(open_menu, self.reset)
+            results[name + '_known'] = self.measure(
+                lambda: (open_menu(), self.wait()), self.reset)
+            self.wait()
+            results[name + '_warm'] = self.measure(open_menu)
+
+        self.reset()
+        summary = {}
+        for name, timings in results.items():
+            summary[name] = self.summarize(timings)
+        return summary
+
+
+def get_version(binary):
+    try:
+        proc = subprocess.Popen([binary, '--version'], stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        return proc.communicate()[0].split('\n')[0].strip()
+    except (OSError):
+        return None
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--vcs', default='git,hg,svn',
+        help='comma-separated VCSs to benchmark [%default]')
+    parser.add_option('--sizes', default='1000,10000,100000',
+        help='comma-separated numbers of files per working copy [%default]')
+    parser.add_option('--modified', type='float', default=0.05,
+        help='fraction of the files to modify [%default]')
+    parser.add_option('--untracked', type='float', default=0.02,
+        help='fraction of untracked files to add [%default]')
+    parser.add_option('--depth', type='int', default=3,
+        help='directory nesting depth [%default]')
+    parser.add_option('--repeat', type='int', default=5,
+        help='number of runs of every measurement [%default]')
+    parser.add_option('--work-dir', default=os.path.join(
+        tempfile.gettempdir(), 'tortoise_bench'),
+        help='directory for the generated working copies [%default]')
+    parser.add_option('--rebuild', action='store_true', default=False,
+        help='generate the working copies again')
+    parser.add_option('--output', help='file to write the JSON results to, ' +
+        'instead of stdout')
+    options, args = parser.parse_args()
+
+    sublime.packages_dir = os.path.join(options.work_dir, 'Packages')
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'options': {
+            'modified': options.modified,
+            'untracked': options.untracked,
+            'depth': options.depth,
+            'repeat': options.repeat
+        },
+        'versions': {},
+        'results': []
+    }
+
+    for vcs in options.vcs.split(','):
+        binary = find_executable(binaries[vcs])
+        if binary == None or (vcs == 'svn' and
+                find_executable('svnadmin') == None):
+            print >> sys.stderr, 'Skipping %s, it is not installed' % vcs
+            continue
+        report['versions'][vcs] = get_version(binary)
+
+        for size in options.sizes.split(','):
+            builder = RepoBuilder(vcs, int(size), options.modified,
+                options.untracked, options.depth, options.work_dir)
+            print >> sys.stderr, 'Generating %s working copy with %s files' % \
+                (vcs, size)
+            builder.build(options.rebuild)
+            print >> sys.stderr, 'Benchmarking %s' % builder.root_dir
+            report['results'].append({
+                'vcs': vcs,
+                'files': int(size),
+                'timings': Benchmark(builder, options.repeat).run()
+            })
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
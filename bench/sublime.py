@@ -0,0 +1,59 @@
+"""
+A headless stand-in for the sublime module, enough to load Tortoise.py
+outside of the editor for benchmarking
+"""
+import os
+import tempfile
+
+settings = {}
+packages_dir = os.path.join(tempfile.gettempdir(), 'tortoise_bench',
+    'Packages')
+
+
+class Settings():
+    def get(self, name, default=None):
+        return settings.get(name, default)
+
+    def set(self, name, value):
+        settings[name] = value
+
+    def add_on_change(self, key, callback):
+        pass
+
+    def clear_on_change(self, key):
+        pass
+
+
+def load_settings(name):
+    return Settings()
+
+
+def packages_path():
+    return packages_dir
+
+
+def set_timeout(callback, delay):
+    # There is no UI thread, so callbacks run right away on the caller's
+    callback()
+
+
+def error_message(message):
+    print 'Error: ' + message
+
+
+def status_message(message):
+    pass
+
+
+def version():
+    return '2221'
+
+
+HIDDEN = 1
+PERSISTENT = 16
+
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b == None else b
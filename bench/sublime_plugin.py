@@ -0,0 +1,21 @@
+"""
+A headless stand-in for the sublime_plugin module
+"""
+
+
+class WindowCommand(object):
+    def __init__(self, window=None):
+        self.window = window
+
+
+class TextCommand(object):
+    def __init__(self, view=None):
+        self.view = view
+
+
+class ApplicationCommand(object):
+    pass
+
+
+class EventListener(object):
+    pass
@@ -0,0 +1,557 @@
+"""
+Tests of the parsers, caches and process handling of Tortoise.py. They run
+headless with the same Python 2 as Sublime Text, using the stub sublime
+modules in bench/. The Git tests are skipped if git is not installed.
+
+    python -m unittest discover tests
+"""
+import sys
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from distutils.spawn import find_executable
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(tests_dir), 'bench'))
+sys.path.insert(1, os.path.dirname(tests_dir))
+
+import Tortoise
+
+
+git_path = find_executable('git')
+
+
+def write(path, content):
+    dir = os.path.dirname(path)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def python_args(code):
+    return [sys.executable, '-c', code]
+
+
+class Clock():
+    """
+    Stands in for the time module, so that expiry can be tested without
+    waiting
+    """
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class IsolatedTestCase(unittest.TestCase):
+    """
+    Gives every test its own status cache and snapshot directory
+    """
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.status_cache = Tortoise.status_cache
+        self.snapshot_store = Tortoise.snapshot_store
+        Tortoise.status_cache = Tortoise.StatusCache(1000)
+        Tortoise.snapshot_store = Tortoise.SnapshotStore()
+        Tortoise.snapshot_store.directory = self.cache_dir
+
+    def tearDown(self):
+        Tortoise.status_cache = self.status_cache
+        Tortoise.snapshot_store = self.snapshot_store
+        shutil.rmtree(self.cache_dir)
+
+
+class GitRepoTestCase(IsolatedTestCase):
+    """
+    Creates a Git repository with a committed file at the root and one in a
+    subdirectory
+    """
+    def setUp(self):
+        IsolatedTestCase.setUp(self)
+        self.root_dir = os.path.realpath(tempfile.mkdtemp())
+        self.git('init', '-q')
+        self.git('config', 'user.name', 'Test')
+        self.git('config', 'user.email', 'test@example.com')
+        write(os.path.join(self.root_dir, 'a.txt'), 'one\ntwo\n')
+        write(os.path.join(self.root_dir, 'dir', 'b.txt'), 'three\n')
+        self.git('add', '.')
+        self.git('commit', '-q', '-m', 'Initial commit')
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+        IsolatedTestCase.tearDown(self)
+
+    def git(self, *args):
+        proc = subprocess.Popen([git_path] + list(args), cwd=self.root_dir,
+            stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise Exception('git %s failed' % args[0])
+        return output.strip()
+
+
+@unittest.skipIf(git_path == None, 'git is not installed')
+class GitIndexTest(GitRepoTestCase):
+    def get_index(self):
+        return Tortoise.GitIndex(os.path.join(self.root_dir, '.git',
+            'index'))
+
+    def check_entries(self, index):
+        self.assertEqual(index.count, 2)
+        entry = index.get('a.txt')
+        self.assertEqual(entry.sha, self.git('hash-object', 'a.txt'))
+        self.assertEqual(entry.size, 8)
+        self.assertEqual(entry.stage, 0)
+        self.assertEqual(index.get('dir/b.txt').sha,
+            self.git('hash-object', 'dir/b.txt'))
+        self.assertEqual(index.get('dir'), None)
+        self.assertEqual(index.get('missing.txt'), None)
+        self.assertTrue(index.has_prefix('dir/'))
+        self.assertFalse(index.has_prefix('di/'))
+
+    def test_version_2(self):
+        self.git('update-index', '--index-version', '2')
+        index = self.get_index()
+        self.assertEqual(index.version, 2)
+        self.check_entries(index)
+
+    def test_version_4(self):
+        # Version 4 compresses names against the previous entry
+        self.git('update-index', '--index-version', '4')
+        index = self.get_index()
+        self.assertEqual(index.version, 4)
+        self.check_entries(index)
+
+    def test_intent_to_add(self):
+        write(os.path.join(self.root_dir, 'c.txt'), 'four\n')
+        self.git('add', '-N', 'c.txt')
+        index = self.get_index()
+        self.assertTrue(index.get('c.txt').intent_to_add)
+        self.assertFalse(index.get('a.txt').intent_to_add)
+
+    def test_invalid_signature(self):
+        write(os.path.join(self.root_dir, '.git', 'index'), 'XXXX' +
+            '\0' * 20)
+        self.assertRaises(Tortoise.UnsupportedFormatError, self.get_index)
+
+
+@unittest.skipIf(git_path == None, 'git is not installed')
+class GitBaseTest(GitRepoTestCase):
+    def setUp(self):
+        GitRepoTestCase.setUp(self)
+        self.vcs = Tortoise.Git(git_path, self.root_dir)
+
+    def tearDown(self):
+        self.vcs.stop()
+        GitRepoTestCase.tearDown(self)
+
+    def check_base(self):
+        path = os.path.join(self.root_dir, 'dir', 'b.txt')
+        base_id = self.vcs.get_base_id(path)
+        self.assertEqual(base_id, self.git('rev-parse', 'HEAD:dir/b.txt'))
+        self.assertEqual(self.vcs.read_base(path, base_id), 'three\n')
+
+        # Directories and files that are not in HEAD have no base
+        self.assertEqual(self.vcs.get_base_id(os.path.join(self.root_dir,
+            'dir')), None)
+        write(os.path.join(self.root_dir, 'c.txt'), 'four\n')
+        self.assertEqual(self.vcs.get_base_id(os.path.join(self.root_dir,
+            'c.txt')), None)
+
+    def test_cat_file(self):
+        self.assertNotEqual(self.vcs.cat_file, None)
+        self.check_base()
+        self.assertEqual(self.vcs.get_head_entry('dir')[0], '40000')
+        self.assertEqual(self.vcs.get_head_entry('a.txt/x'), None)
+
+    def test_without_helpers(self):
+        self.vcs.stop()
+        self.vcs.cat_file = None
+        self.assertRaises(Tortoise.UnsupportedFormatError,
+            self.vcs.get_head_entry, 'a.txt')
+        self.check_base()
+
+
+@unittest.skipIf(git_path == None, 'git is not installed')
+class GitStatusTest(GitRepoTestCase):
+    def setUp(self):
+        GitRepoTestCase.setUp(self)
+        self.vcs = Tortoise.Git(git_path, self.root_dir)
+
+    def tearDown(self):
+        self.vcs.stop()
+        GitRepoTestCase.tearDown(self)
+
+    def test_check_ignore(self):
+        write(os.path.join(self.root_dir, '.gitignore'), '*.log\n!keep.log\n')
+        self.assertEqual(self.vcs.check_ignore.run(['a.log', 'a.txt',
+            'keep.log', 'dir/b.log']), [True, False, False, True])
+        # Requests after a crash restart the process
+        self.vcs.check_ignore.proc.kill()
+        self.vcs.check_ignore.proc.wait()
+        self.assertEqual(self.vcs.check_ignore.run(['a.log']), [True])
+
+    def test_stale_snapshot(self):
+        path = os.path.join(self.root_dir, 'new.txt')
+        write(path, 'four\n')
+        self.vcs.refresh_snapshot(self.vcs.get_fingerprint())
+
+        # Adding a file leaves it untouched, only the index changes. After a
+        # restart the stored snapshot is shown, but not trusted.
+        self.git('add', 'new.txt')
+        Tortoise.status_cache = Tortoise.StatusCache(1000)
+        vcs = Tortoise.Git(git_path, self.root_dir)
+        try:
+            snapshot = vcs.get_cached_snapshot()
+            self.assertEqual(snapshot.get(path), '?')
+            self.assertEqual(snapshot.fingerprint, None)
+            self.assertEqual(vcs.check_status(path, vcs.get_fingerprint(),
+                5), 'A')
+        finally:
+            vcs.stop()
+
+    def test_soft_reset(self):
+        path = os.path.join(self.root_dir, 'a.txt')
+        self.assertEqual(self.vcs.get_snapshot(path,
+            self.vcs.get_fingerprint(), 5).get(path), '')
+        write(path, 'one\ntwo\nthree\n')
+        self.git('commit', '-q', '-a', '-m', 'Second commit')
+        self.vcs.get_snapshot(path, self.vcs.get_fingerprint(), 5)
+        # Only the branch ref moves
+        self.git('reset', '-q', '--soft', 'HEAD~1')
+        self.assertEqual(self.vcs.get_snapshot(path,
+            self.vcs.get_fingerprint(), 5).get(path), 'M')
+
+    def test_failed_status(self):
+        snapshot = self.vcs.refresh_snapshot(self.vcs.get_fingerprint())
+
+        fake_git = os.path.join(self.cache_dir, 'git')
+        write(fake_git, '#!%s\nimport sys\n' % sys.executable +
+            'sys.stderr.write("fatal: detected dubious ownership\\n")\n' +
+            'sys.exit(128)\n')
+        os.chmod(fake_git, 0755)
+        vcs = Tortoise.Git(fake_git, self.root_dir)
+        vcs.stop()
+        try:
+            vcs.refresh_snapshot(None)
+            self.fail('The failed status was not raised')
+        except (Tortoise.ProcessError) as (exception):
+            self.assertEqual(exception.returncode, 128)
+        # Neither the cached nor the stored snapshot is replaced
+        self.assertTrue(Tortoise.status_cache.get_snapshot(self.root_dir) is
+            snapshot)
+        self.assertEqual(Tortoise.snapshot_store.load(self.root_dir,
+            snapshot.fingerprint, self.vcs.get_revision()).fingerprint,
+            snapshot.fingerprint)
+
+
+class NonInteractiveProcessTest(unittest.TestCase):
+    def setUp(self):
+        self.timeout = Tortoise.NonInteractiveProcess.timeout
+
+    def tearDown(self):
+        Tortoise.NonInteractiveProcess.timeout = self.timeout
+
+    def test_records(self):
+        proc = Tortoise.NonInteractiveProcess(python_args(
+            'import sys; sys.stdout.write("a\\0b\\0c")'))
+        self.assertEqual(proc.stream(list, '\0'), ['a', 'b', 'c'])
+
+    def test_failure(self):
+        proc = Tortoise.NonInteractiveProcess(python_args(
+            'import sys; print "fatal: not a git repository"; sys.exit(128)'))
+        try:
+            proc.stream(list)
+            self.fail('The exit status was not raised')
+        except (Tortoise.ProcessError) as (exception):
+            self.assertEqual(exception.returncode, 128)
+        self.assertRaises(Tortoise.ProcessError, proc.find,
+            lambda record: False)
+
+    def test_find_stops_early(self):
+        # The process would never exit by itself
+        proc = Tortoise.NonInteractiveProcess(python_args(
+            'import sys\nwhile True: print "record"; sys.stdout.flush()'))
+        start_time = time.time()
+        self.assertEqual(proc.find(lambda record: record == 'record'),
+            'record')
+        self.assertTrue(time.time() - start_time < 5)
+
+    def test_timeout(self):
+        Tortoise.NonInteractiveProcess.timeout = 1
+        proc = Tortoise.NonInteractiveProcess(python_args(
+            'import time; time.sleep(30)'))
+        start_time = time.time()
+        self.assertRaises(Tortoise.ProcessTimeoutError, proc.stream, list)
+        self.assertTrue(time.time() - start_time < 10)
+
+
+class ProcessSchedulerTest(unittest.TestCase):
+    def test_shared_run(self):
+        scheduler = Tortoise.ProcessScheduler(4, 2)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def run():
+            calls.append(True)
+            started.set()
+            release.wait()
+            return 'output'
+
+        def request():
+            results.append(scheduler.run('/root', ('git', 'status'), run))
+        threads = [threading.Thread(target=request) for i in range(3)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        # Wait until the other requests have joined the running one
+        while scheduler.stats()['shared'] < 2:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['output'] * 3)
+        self.assertEqual(scheduler.stats()['running'], 0)
+
+    def test_shared_error(self):
+        scheduler = Tortoise.ProcessScheduler(4, 2)
+
+        def run():
+            raise Tortoise.ProcessError('failed', 1)
+        self.assertRaises(Tortoise.ProcessError, scheduler.run, '/root',
+            ('git', 'status'), run)
+        self.assertEqual(scheduler.stats()['running'], 0)
+
+
+class SVNStatusTest(unittest.TestCase):
+    xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<status>
+<target path=".">
+<entry path="modified.txt">
+<wc-status props="none" item="modified" revision="3"></wc-status>
+</entry>
+<entry path="props.txt">
+<wc-status props="modified" item="normal" revision="3"></wc-status>
+</entry>
+<entry path="normal.txt">
+<wc-status props="none" item="normal" revision="3"></wc-status>
+</entry>
+<entry path="dir">
+<wc-status props="none" item="normal" revision="3" tree-conflicted="true">
+</wc-status>
+</entry>
+<entry path="new">
+<wc-status props="none" item="unversioned"></wc-status>
+</entry>
+<entry path="ext">
+<wc-status props="none" item="external"></wc-status>
+</entry>
+</target>
+<target path="ext">
+<entry path="ext/a.c">
+<wc-status props="none" item="added" revision="-1"></wc-status>
+</entry>
+</target>
+</status>
+'''
+
+    def setUp(self):
+        self.vcs = Tortoise.SVN(tests_dir)
+
+    def test_xml_statuses(self):
+        statuses = self.vcs.parse_xml_statuses(iter(self.xml.split('\n')))
+        self.assertEqual(statuses, {
+            'modified.txt': 'M',
+            'props.txt': 'M',
+            'dir': 'C',
+            'new': '?',
+            'ext': 'X',
+            os.path.join('ext', 'a.c'): 'A'
+        })
+
+    def test_no_document(self):
+        self.assertRaises(Tortoise.ProcessError,
+            self.vcs.parse_xml_statuses, iter(['']))
+
+
+class LineDiffTest(unittest.TestCase):
+    def setUp(self):
+        self.base = ['a', 'b', 'c', 'd']
+        self.diff = Tortoise.LineDiff('id', self.base)
+        self.diff.update(list(self.base))
+
+    def test_unchanged(self):
+        self.assertEqual(self.diff.get_changes(), ([], [], []))
+
+    def test_modified(self):
+        self.diff.update(['a', 'x', 'c', 'd'])
+        self.assertEqual(self.diff.get_changes(), ([], [1], []))
+
+    def test_added(self):
+        self.diff.update(['a', 'b', 'x', 'y', 'c', 'd'])
+        self.assertEqual(self.diff.get_changes(), ([2, 3], [], []))
+
+    def test_deleted(self):
+        self.diff.update(['a', 'b', 'd'])
+        self.assertEqual(self.diff.get_changes(), ([], [], [2]))
+        self.diff.update(['a', 'b', 'c'])
+        self.assertEqual(self.diff.get_changes(), ([], [], [2]))
+
+    def test_successive_edits(self):
+        # Every edit only rediffs the lines around it
+        self.diff.update(['a', 'x', 'c', 'd'])
+        self.diff.update(['a', 'x', 'c', 'y', 'd'])
+        self.assertEqual(self.diff.get_changes(), ([3], [1], []))
+        self.diff.update(['a', 'b', 'c', 'y', 'd'])
+        self.assertEqual(self.diff.get_changes(), ([3], [], []))
+        self.assertEqual(self.diff.base_indexes, [0, 1, 2, None, 3])
+
+
+class StatusCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock(1000.0)
+        Tortoise.time = self.clock
+        self.cache = Tortoise.StatusCache(2)
+
+    def tearDown(self):
+        Tortoise.time = time
+
+    def test_expiry(self):
+        self.cache.set('/root', '/root/a', 'M', None, None, 5)
+        self.clock.now += 4.9
+        self.assertEqual(self.cache.get('/root', '/root/a', None, None), 'M')
+        # Entries expired at twice the cache length before
+        self.clock.now += 0.2
+        self.assertEqual(self.cache.get('/root', '/root/a', None, None), None)
+
+    def test_fingerprint(self):
+        self.cache.set('/root', '/root/a', 'M', ('index',), (1.0, 2), 5)
+        self.clock.now += 60
+        self.assertEqual(self.cache.get('/root', '/root/a', ('index',),
+            (1.0, 2)), 'M')
+        self.assertEqual(self.cache.get('/root', '/root/a', ('index',),
+            (2.0, 2)), None)
+        self.assertEqual(self.cache.get('/root', '/root/a', ('index 2',),
+            (1.0, 2)), None)
+
+    def test_eviction(self):
+        self.cache.set('/root', '/root/a', 'M', None, None, 5)
+        self.cache.set('/other', '/other/b', 'A', None, None, 5)
+        self.cache.get('/root', '/root/a', None, None)
+        self.cache.set('/root', '/root/c', '?', None, None, 5)
+        # The least recently used entry is evicted, whatever its root
+        self.assertEqual(self.cache.get('/other', '/other/b', None, None),
+            None)
+        self.assertEqual(self.cache.get('/root', '/root/a', None, None), 'M')
+        self.assertEqual(self.cache.evictions, 1)
+
+
+class StatusStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = Tortoise.StatusStore({
+            'a': 'M',
+            os.path.join('dir', 'b'): '?',
+            os.path.join('dir', 'sub', 'c'): 'C',
+            'di': 'D',
+            'dirx': 'A',
+            'clean': ''
+        })
+
+    def test_get(self):
+        self.assertEqual(len(self.store), 5)
+        self.assertEqual(self.store.get(os.path.join('dir', 'b')), '?')
+        self.assertEqual(self.store.get('dir'), None)
+        self.assertEqual(self.store.get('clean'), None)
+
+    def test_prefix_ranges(self):
+        # Paths that only share a prefix with a directory are not within it
+        self.assertEqual(str(self.store.get_codes('dir')), '?C')
+        self.assertEqual(str(self.store.get_codes('di')), 'D')
+        self.assertEqual(str(self.store.get_codes('.')), 'MD?CA')
+        self.assertEqual(list(self.store.iteritems('dir')), [
+            (os.path.join('dir', 'b'), '?'),
+            (os.path.join('dir', 'sub', 'c'), 'C')])
+        self.assertEqual(list(self.store.iteritems(os.path.join('dir',
+            'sub'))), [(os.path.join('dir', 'sub', 'c'), 'C')])
+        self.assertEqual(list(self.store.iteritems('missing')), [])
+
+    def test_set_remove(self):
+        version = self.store.version
+        self.store.set(os.path.join('dir', 'e'), 'M')
+        self.assertEqual(str(self.store.get_codes('dir')), '?MC')
+        self.store.set('a', 'M')
+        self.assertEqual(self.store.version, version + 1)
+        self.store.remove(os.path.join('dir', 'b'))
+        self.assertEqual(str(self.store.get_codes('dir')), 'MC')
+        self.assertEqual(self.store.version, version + 2)
+
+    def test_case(self):
+        # Windows looks paths up without case, but they are shown as the
+        # VCS reported them
+        normcase = os.path.normcase
+        os.path.normcase = lambda path: path.lower()
+        try:
+            store = Tortoise.StatusStore({os.path.join('Dir', 'B.txt'): 'M'})
+            self.assertEqual(store.get(os.path.join('dir', 'b.TXT')), 'M')
+            self.assertEqual(list(store.iteritems('DIR')), [
+                (os.path.join('Dir', 'B.txt'), 'M')])
+        finally:
+            os.path.normcase = normcase
+
+
+class SnapshotStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = os.path.realpath(tempfile.mkdtemp())
+        self.store = Tortoise.SnapshotStore()
+        self.store.directory = os.path.join(self.root_dir, 'cache')
+        self.statuses = {'a.txt': 'M', os.path.join('dir', 'b.txt'): '?'}
+        self.fingerprint = ((1.0, 10),)
+        snapshot = Tortoise.StatusSnapshot(self.root_dir, self.statuses,
+            time.time(), self.fingerprint)
+        self.store.save(snapshot, 'r1')
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def get_statuses(self, snapshot):
+        return dict(snapshot.statuses.iteritems())
+
+    def test_fresh(self):
+        snapshot = self.store.load(self.root_dir, self.fingerprint, 'r1')
+        self.assertEqual(self.get_statuses(snapshot), self.statuses)
+        self.assertEqual(snapshot.fingerprint, self.fingerprint)
+
+    def test_new_revision(self):
+        snapshot = self.store.load(self.root_dir, self.fingerprint, 'r2')
+        self.assertEqual(self.get_statuses(snapshot), self.statuses)
+        self.assertEqual(snapshot.fingerprint, None)
+
+    def test_new_fingerprint(self):
+        # Stale snapshots are shown until a full refresh replaces them
+        snapshot = self.store.load(self.root_dir, ((2.0, 10),), 'r1')
+        self.assertEqual(self.get_statuses(snapshot), self.statuses)
+        self.assertEqual(snapshot.fingerprint, None)
+
+    def test_missing(self):
+        self.assertEqual(self.store.load(os.path.join(self.root_dir, 'dir'),
+            self.fingerprint, 'r1'), None)
+
+    def test_disabled(self):
+        self.store.enabled = False
+        self.assertEqual(self.store.load(self.root_dir, self.fingerprint,
+            'r1'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()